@@ -1,11 +1,35 @@
 import dash
-from dash import dcc, html, Input, Output, State, _dash_renderer
+import flask
+from dash import dcc, html, ctx, no_update, Input, Output, Patch, State, ClientsideFunction, _dash_renderer
 import plotly.express as px
-import plotly.figure_factory as ff
 import polars as pl
 import dash_mantine_components as dmc
+from dash.exceptions import PreventUpdate
+import functools
+import logging
 import os
+import threading
+import time
+from bar_chart import bar_figure, top_counts
+from data import DATA_PATH, column_options, load_data, partition_scanner, source_stamp
+from bitmap_index import BitmapIndex
+from client_filter import CLIENT_INPUTS, SUBSET_COLUMNS, encode_subset, subset_state
+from cube import FacetCube
+from figure_cache import load_figure_cache
+from filter_engine import FilterEngine, FilterState, normalize_filters
+from hexbin import compute_hexbin, data_extent, hexbin_figure
+import metrics
+from payload import instrument
+from pyramid import HexPyramid
+from render_pool import Superseded, TaskPool, in_worker
+from sampling import BUDGET_MS, sample_points, throughput
+from snapshot import load_snapshot
+from spatial import QUADKEY
+from timeline import timeline_figure, year_span
+from viewport import clip_points, map_revision, parse_viewport, sort_points
 _dash_renderer._set_react_version("18.2.0")
+logging.basicConfig(level=logging.INFO)
+STARTED_AT = time.perf_counter()
 
 # Helper Functions
 def get_mapbox_token():
@@ -21,47 +45,169 @@ def get_mapbox_token():
         )
 
 
-def load_data():
-    """Load and preprocess the dataset."""
-    data = pl.read_parquet("./data/dragonfly_database.parquet",
-        columns=["gbifID", "occurrenceID", "country", "species", "lifeStage", "sex", "publisher",
-                 "basisOfRecord", "decimalLatitude", "decimalLongitude", "coordinateUncertaintyInMeters"]
-    )
-    data = data.rename({
-        "species": "Species",
-        "sex": "Sex",
-        "lifeStage": "LifeStage",
-        "publisher": "Publisher",
-        "country": "Country",
-        "coordinateUncertaintyInMeters" : "Uncertainty"
-    })
-    data = data.with_columns(
-    [
-        pl.col("LifeStage").cast(str),
-        pl.col("Sex").cast(str),
-        pl.col("Species").cast(str)
-    ]
-    )
-    return data
-
-
 # Configuration
+DATA_MODE = os.environ.get("GBIF_DATA_MODE", "eager")
 MAPBOX_TOKEN = get_mapbox_token()
 px.set_mapbox_access_token(MAPBOX_TOKEN)
 
-data = load_data()
-regions = ["All"] + sorted(data["Country"].unique().to_list())
-life_stages = ["All"] + sorted(data["LifeStage"].fill_null("Unknown").unique().to_list())
-#life_stages = ['None' if ls is None else ls for ls in life_stages]
-sex_options = ["All"] + sorted(data["Sex"].fill_null("Unknown").unique().to_list())
-#sex_options = ['None' if ls is None else ls for ls in sex_options]
-species_options = ["All"] + sorted(data["Species"].fill_null("Unknown").unique().to_list())
-#species_options = ['None' if ls is None else ls for ls in species_options]
+USE_SNAPSHOT = os.environ.get("GBIF_SNAPSHOT", "1") == "1"
+MAP_WORKERS = int(os.environ.get("GBIF_MAP_WORKERS", 2))
+CLIENT_FILTER_MAX_ROWS = int(os.environ.get("GBIF_CLIENT_MAX_ROWS", 20_000))
+OPTIONS_CACHE_SIZE = int(os.environ.get("GBIF_OPTIONS_CACHE_SIZE", 256))
+OPTIONS_PREWARM = int(os.environ.get("GBIF_OPTIONS_PREWARM", 20))
+SPECIES_OPTIONS_LIMIT = int(os.environ.get("GBIF_SPECIES_OPTIONS_LIMIT", 200))
+FIGURE_PREWARM = int(os.environ.get("GBIF_FIGURE_PREWARM", 10))
+BAR_LIMIT = int(os.environ.get("GBIF_BAR_LIMIT", 30))
+DEFAULT_UNCERTAINTY = 1000
+DEFAULT_HEXSIZE = 100
+DEFAULT_PARA = "Country"
+
+if USE_SNAPSHOT:
+    # Lazy and mmap modes hold the rows themselves and only need the cubes.
+    snapshot = load_snapshot(DATA_PATH, frame=DATA_MODE == "eager")
+    data = snapshot.data if DATA_MODE == "eager" else load_data(DATA_MODE)
+    facet_cube = FacetCube(snapshot.cube, snapshot.time_cube)
+    snapshot_options = snapshot.options
+    del snapshot
+else:
+    snapshot_options = None
+    data = load_data(DATA_MODE)
+    facet_cube = FacetCube.from_data(data)
+YEAR_RANGE = facet_cube.year_range()
+bitmap_index = BitmapIndex.load(source=DATA_PATH, n_rows=data.height) if DATA_MODE != "lazy" else None
+filter_engine = FilterEngine(data, maxsize=int(os.environ.get("FILTER_CACHE_SIZE", 16)), index=bitmap_index,
+                             scanner=partition_scanner(DATA_PATH) if DATA_MODE == "lazy" else None)
+hex_pyramid = HexPyramid.load(source=DATA_PATH)
+GEOMETRY_VERSION = source_stamp(DATA_PATH)["source_mtime_ns"]
+render_pool = TaskPool(MAP_WORKERS) if MAP_WORKERS > 0 else None
+figure_cache = load_figure_cache(DATA_PATH)
+
+
+def year_filter(years):
+    """The year range picked on the slider, or None when it spans every year."""
+    if not years or YEAR_RANGE is None:
+        return None
+    first, last = min(years), max(years)
+    if first <= YEAR_RANGE[0] and last >= YEAR_RANGE[1]:
+        return None
+    return first, last
+
+
+def filter_cache_gauges():
+    """Filter cache state for ``/metrics``."""
+    info = filter_engine.cache_info()
+    options = facet_values.cache_info()
+    return {
+        "gbif_filter_cache_hits": ("Filter cache hits since startup.", info.hits),
+        "gbif_filter_cache_misses": ("Filter cache misses since startup.", info.misses),
+        "gbif_filter_cache_entries": ("Filtered frames currently cached.", info.currsize),
+        "gbif_options_cache_hits": ("Option list cache hits since startup.", options.hits),
+        "gbif_options_cache_misses": ("Option list cache misses since startup.", options.misses),
+        **({} if figure_cache is None else {
+            "gbif_figure_cache_hits": ("Shared figure cache hits since startup.", figure_cache.hits),
+            "gbif_figure_cache_misses": ("Shared figure cache misses since startup.", figure_cache.misses),
+            "gbif_figure_cache_megabytes": ("Size of the shared figure cache on disk.", figure_cache.volume_mb()),
+        }),
+    }
+
+
+def facet_options(state, column):
+    """Option values for a dropdown under ``state``, from the cube when possible."""
+    with metrics.stage("aggregate"):
+        options = facet_cube.options(state, column)
+        if options is None:
+            options = column_options(filter_engine.filtered(state, columns=[column]), column)
+    return options
+
+
+OPTION_COLUMNS = ["Species", "LifeStage", "Sex"]
+
+
+@functools.lru_cache(maxsize=OPTIONS_CACHE_SIZE)
+def facet_values(state, column):
+    """Memoized option values of a dropdown under ``state``."""
+    return tuple(facet_options(state, column))
+
+
+def top_countries(n):
+    """The ``n`` countries with the most occurrences under the default filters."""
+    counts = facet_cube.group_counts(normalize_filters(uncertainty=DEFAULT_UNCERTAINTY), "Country")
+    if counts is None:
+        return []
+    return counts.drop_nulls("Country").sort("count", descending=True)["Country"].head(n).to_list()
+
+
+def prewarm_options():
+    """Compute the option lists for the default filters and each of the most common countries."""
+    start = time.perf_counter()
+    default = normalize_filters(uncertainty=DEFAULT_UNCERTAINTY)
+    states = [default] + [default._replace(country=(country,)) for country in top_countries(OPTIONS_PREWARM)]
+    for state in states:
+        for column in OPTION_COLUMNS:
+            facet_values(state, column)
+    logging.getLogger(__name__).info("Prewarmed option lists for %d filter states in %.2fs",
+                                     len(states), time.perf_counter() - start)
+
+
+def initial_options(column):
+    """Unfiltered option values, precomputed in the snapshot when there is one."""
+    if snapshot_options is not None:
+        return snapshot_options[column]
+    return facet_options(FilterState(), column)
+
+
+# Render workers import the app too but never serve the dropdowns.
+if OPTIONS_PREWARM > 0 and not in_worker():
+    threading.Thread(target=prewarm_options, name="prewarm-options", daemon=True).start()
+
+regions = ["All"] + initial_options("Country")
+life_stages = ["All"] + initial_options("LifeStage")
+sex_options = ["All"] + initial_options("Sex")
+species_options = ["All"] + initial_options("Species")[:SPECIES_OPTIONS_LIMIT]
 variables = ["Country", "Species", "Sex", "LifeStage", "Publisher"]
+# Slider bounds; a placeholder range keeps the slider valid for data without dates.
+YEARS = YEAR_RANGE or (0, 1)
+
+
 
 # App Initialization
-app = dash.Dash(__name__, external_stylesheets=dmc.styles.ALL)
+app = dash.Dash(__name__, external_stylesheets=dmc.styles.ALL, compress=True)
 server = app.server
+instrument(server)
+metrics.instrument(server, gauges=filter_cache_gauges)
+
+
+@server.before_request
+def log_first_request():
+    """Log how long it took from import to the first request being served."""
+    global first_request_logged
+    if not first_request_logged:
+        first_request_logged = True
+        logging.getLogger(__name__).info("First request %.2fs after startup", time.perf_counter() - STARTED_AT)
+
+
+first_request_logged = False
+
+
+@server.route("/hexbins/<int:level>.geojson")
+def hexbin_geometry(level):
+    """Shared hexagon polygons of one pyramid level, cached by the browser for good."""
+    if hex_pyramid is None or level not in hex_pyramid.grids:
+        flask.abort(404)
+    response = flask.Response(hex_pyramid.geometry(level), mimetype="application/json")
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
+
+def geometry_url(grid):
+    """URL of the shared GeoJSON holding ``grid``'s hexagons, or None to inline them."""
+    level = hex_pyramid.shared_geometry_level(grid) if hex_pyramid is not None else None
+    if level is None:
+        return None
+    # The source's mtime in the URL invalidates browser caches when the data changes.
+    return app.get_relative_path(f"/hexbins/{level}.geojson?v={GEOMETRY_VERSION}")
 
 # Styles
 STYLES = {
@@ -126,6 +272,10 @@ def create_map_controls():
                 data=[{"value": s, "label": s} for s in species_options],
                 id="species",
                 label="Select Species",
+                searchable=True,
+                debounce=250,
+                placeholder="Type to search",
+                nothingFoundMessage="No matching species",
             ),
             dmc.Select(
                             data=[
@@ -136,13 +286,25 @@ def create_map_controls():
                                 {"value": "500", "label": "<=500"},
                                 {"value": "1000", "label": "<=1000"}
                             ],
-                            value=1000,  # Default to 1000
+                            value=DEFAULT_UNCERTAINTY,
                             id="uncertainty",
                             label="Select Uncertainty (m)",
                         ),
+            dmc.Text("Select Years", size="sm"),
+            dmc.RangeSlider(
+                id="years",
+                min=YEARS[0],
+                max=YEARS[1],
+                value=list(YEARS),
+                step=1,
+                minRange=0,
+                marks=[{"value": year, "label": str(year)} for year in YEARS],
+                disabled=YEAR_RANGE is None,
+                mb="md",
+            ),
             dmc.Text("Select number of HexBins", size="sm"),
             dmc.Slider(
-                value=100,
+                value=DEFAULT_HEXSIZE,
                 min=50,
                 max=200,
                   marks=[
@@ -163,7 +325,7 @@ def create_graph_controls():
     """Creates control elements for variable selection."""
     return dmc.Select(
         data=[{"value": str(v), "label": str(v)} for v in variables],
-        value="Country",
+        value=DEFAULT_PARA,
         id="para",
         label="Variable Selection",
     )
@@ -185,11 +347,21 @@ app.layout = dmc.MantineProvider([html.Div(
                     style=STYLES["box"],
                     children=[
                         html.Div(id="occurrences_card", style={"marginBottom": "1rem"}),
-                        dcc.Graph(
-                            id="map",
-                            config={"displayModeBar": "hover", "scrollZoom": True},
-                            style={"height": "500px"},
+                        dcc.Store(id="client_subset"),
+                        html.Div(
+                            style={"position": "relative"},
+                            children=[
+                                dmc.LoadingOverlay(id="map_loading", visible=False, zIndex=10),
+                                dcc.Graph(
+                                    id="map",
+                                    config={"displayModeBar": "hover", "scrollZoom": True},
+                                    style={"height": "500px"},
+                                ),
+                            ],
                         ),
+                        dcc.Store(id="map_viewport"),
+                        dcc.Store(id="map_refine"),
+                        dcc.Store(id="client_id"),
                     ],
                 ),
             ],
@@ -209,6 +381,11 @@ app.layout = dmc.MantineProvider([html.Div(
                             config={"displayModeBar": "hover"},
                             style={"height": "400px"},
                         ),
+                        dcc.Graph(
+                            id="timeline",
+                            config={"displayModeBar": "hover"},
+                            style={"height": "300px"},
+                        ),
                     ],
                 ),
             ],
@@ -220,127 +397,419 @@ app.layout = dmc.MantineProvider([html.Div(
 
 
 # Callbacks
-@app.callback(
-    Output("occurrences_card", "children"),
-    Input("country", "value"),
-    Input("life_stage", "value"),
-    Input("sex", "value"),
-    Input("species", "value"),
-    Input("uncertainty", "value")
-)
-def update_occurrences_card(country, life_stage, sex, species, uncertainty):
+# The outputs below are computed by plain functions and wired up at the end of
+# this section: the map through its own callback, which renders in a pool of
+# worker processes, and everything else through a single callback.
+@metrics.timed
+def update_occurrences_card(country, life_stage, sex, species, uncertainty, years=None):
     """Update the occurrences card based on the selected region and filters."""
-    df = data
-    if country and country != "All":
-        df = df.filter(pl.col("Country").is_in(country))
-    if life_stage and life_stage != "All":
-        df = df.filter(pl.col("LifeStage") == life_stage)
-    if sex and sex != "All":
-        df = df.filter(pl.col("Sex") == sex)
-    if species and species != "All":
-        df = df.filter(pl.col("Species") == species)
-    if uncertainty:
-        df = df.filter(pl.col("Uncertainty") <= int(uncertainty))  # Convert string to int for comparison
-
-    return f"Occurrences: {len(df)}"
+    state = normalize_filters(country, life_stage, sex, species, uncertainty, year_filter(years))
+    with metrics.stage("aggregate"):
+        count = facet_cube.count(state)
+        if count is None:
+            count = filter_engine.count(state)
+    metrics.rows(count)
+
+    return f"Occurrences: {count}"
+
+
+@metrics.timed
+def update_map(country, life_stage, sex, species, hexsize, uncertainty, viewport_data=None, checkpoint=None,
+               exact=False, years=None):
+    """Build the hexbin map for the filters, restricted to the viewport when one is set.
+
+    Unless ``exact`` is set, points beyond what can be binned within
+    GBIF_MAP_BUDGET_MS are sampled and the counts estimated. ``checkpoint`` is
+    called before each slow stage and may raise to abandon the render.
+    """
+    checkpoint = checkpoint or (lambda: None)
+    state = normalize_filters(country, life_stage, sex, species, uncertainty, year_filter(years))
+    revision = map_revision(state)
+    viewport = parse_viewport(viewport_data, revision)
+    # Zoomed-in views rarely repeat, so only whole maps are shared.
+    shared = figure_cache is not None and viewport is None
+    if shared:
+        with metrics.stage("cache"):
+            fig = figure_cache.get("map", state, int(hexsize))
+        if fig is not None:
+            return fig
+
+    with metrics.stage("aggregate"):
+        bins = hex_pyramid.lookup(state, int(hexsize), viewport) if hex_pyramid is not None else None
+    if bins is None:
+        checkpoint()
+        with metrics.stage("filter"):
+            df = filter_engine.filtered(state, columns=["decimalLatitude", "decimalLongitude", QUADKEY])
+            if viewport is not None:
+                points = filter_engine.cached(("sorted_points", state), lambda: sort_points(df))
+                df = clip_points(points, viewport)
+        checkpoint()
+        with metrics.stage("aggregate"):
+            # The grid spans all the points, so the exact render replaces the hexagons one for one.
+            extent = data_extent(df) if viewport is None else (viewport.lat_range, viewport.lon_range)
+            fraction = 1.0
+            if not exact and BUDGET_MS > 0:
+                df, fraction = sample_points(df, throughput.budget_rows())
+            start = time.perf_counter()
+            bins = compute_hexbin(df, int(hexsize), extent=extent, fraction=fraction) if extent else None
+            if fraction == 1.0:
+                throughput.observe(df.height, time.perf_counter() - start)
+    if bins is not None:
+        metrics.rows(bins.counts.sum())
+
+    checkpoint()
+    with metrics.stage("figure"):
+        fig = hexbin_figure(
+            bins,
+            opacity=0.4,
+            color_continuous_scale="turbo",
+            label="Point Count",
+            mapbox_token=MAPBOX_TOKEN,
+            uirevision=revision,
+            geometry=geometry_url(bins.grid) if bins is not None else None,
+        )
+    if shared and (bins is None or bins.fraction == 1):
+        with metrics.stage("cache"):
+            figure_cache.set("map", state, int(hexsize), fig=fig)
+    return fig
+
+
+@metrics.timed
+def update_graph(country, life_stage, sex, species, para, uncertainty, years=None):
+    """Build the bar chart of occurrences per value of ``para``."""
+    state = normalize_filters(country, life_stage, sex, species, uncertainty, year_filter(years))
+    if figure_cache is not None:
+        with metrics.stage("cache"):
+            fig = figure_cache.get("graph", state, para)
+        if fig is not None:
+            return fig
+
+    # Example graph generation based on the selected parameter
+    with metrics.stage("aggregate"):
+        grouped = facet_cube.group_counts(state, para)
+    if grouped is None:
+        with metrics.stage("filter"):
+            df = filter_engine.filtered(state, columns=[para])
+        with metrics.stage("aggregate"):
+            grouped = df.group_by(para).agg(pl.len().alias("count"))
+    with metrics.stage("aggregate"):
+        bars = top_counts(grouped, para, BAR_LIMIT)
+    metrics.rows(bars["count"].sum())
+    with metrics.stage("figure"):
+        fig = bar_figure(bars, para, BAR_LIMIT)
+    if figure_cache is not None:
+        with metrics.stage("cache"):
+            figure_cache.set("graph", state, para, fig=fig)
+    return fig
+
+
+@metrics.timed
+def update_timeline(country, life_stage, sex, species, uncertainty, years=None):
+    """Build the monthly time series under every filter but the year range, which is shaded instead."""
+    state = normalize_filters(country, life_stage, sex, species, uncertainty)
+    with metrics.stage("aggregate"):
+        counts = facet_cube.month_counts(state)
+    if counts is None:
+        with metrics.stage("filter"):
+            df = filter_engine.filtered(state, columns=["Year", "Month"])
+        with metrics.stage("aggregate"):
+            counts = (
+                df.filter(pl.col("Year").is_not_null())
+                .group_by(["Year", "Month"])
+                .agg(pl.len().alias("count"))
+                .sort(["Year", "Month"], nulls_last=True)
+            )
+    metrics.rows(counts["count"].sum())
+    with metrics.stage("figure"):
+        return timeline_figure(counts, year_filter(years))
+
+
+def option_data(values):
+    return [{"value": s, "label": s} for s in values] + [{"value": "All", "label": "All"}]
+
+
+def species_matches(values, search=None, selected=None):
+    """At most SPECIES_OPTIONS_LIMIT species containing ``search``, plus the selected one.
+
+    The search box shows the selected species' name once one is picked, which
+    lists everything rather than just that species.
+    """
+    if search and search != selected:
+        needle = search.casefold()
+        values = [value for value in values if needle in value.casefold()]
+    shown = list(values[:SPECIES_OPTIONS_LIMIT])
+    if selected and selected != "All" and selected not in shown:
+        shown.append(selected)
+    return shown
+
+
+@metrics.timed
+def update_selection_options(country, life_stage, sex, uncertainty, species_search=None, species=None, years=None):
+    """Species, life stage and sex options under the current filters.
+
+    The lists come from a bounded cache keyed by the filter state. Species are
+    matched against the dropdown's search text on the server and capped, so
+    only a page of them is sent however many there are.
+    """
+    state = normalize_filters(country, life_stage, sex, None, uncertainty, year_filter(years))
+    species_data = option_data(species_matches(facet_values(state, "Species"), species_search, species))
+    life_stage_data = option_data(facet_values(state, "LifeStage"))
+    sex_data = option_data(facet_values(state, "Sex"))
+    return species_data, life_stage_data, sex_data
+
+
+def map_patch(fig):
+    """Partial update carrying only what changes between two hexbin maps."""
+    patched = Patch()
+    trace, coloraxis = fig["data"][0], fig["layout"]["coloraxis"]
+    patched["data"][0]["geojson"] = trace["geojson"]
+    patched["data"][0]["locations"] = trace["locations"]
+    patched["data"][0]["z"] = trace["z"]
+    patched["layout"]["coloraxis"]["cmin"] = coloraxis["cmin"]
+    patched["layout"]["coloraxis"]["cmax"] = coloraxis["cmax"]
+    patched["layout"]["coloraxis"]["colorbar"]["title"]["text"] = coloraxis["colorbar"]["title"]["text"]
+    patched["data"][0]["hovertemplate"] = trace["hovertemplate"]
+    patched["layout"]["annotations"] = fig["layout"]["annotations"]
+    patched["layout"]["meta"] = fig["layout"]["meta"]
+    return patched
+
+
+def graph_patch(fig):
+    """Partial update carrying only the bars, hover text and titles of the bar chart."""
+    patched = Patch()
+    trace, layout = fig["data"][0], fig["layout"]
+    patched["data"][0]["x"] = trace["x"]
+    patched["data"][0]["y"] = trace["y"]
+    patched["data"][0]["hovertemplate"] = trace["hovertemplate"]
+    patched["layout"]["title"]["text"] = layout["title"]["text"]
+    patched["layout"]["xaxis"]["title"]["text"] = layout["xaxis"]["title"]["text"]
+    return patched
+
+
+def timeline_patch(years):
+    """Partial update moving the shaded year range of the time series."""
+    patched = Patch()
+    years = year_filter(years)
+    patched["layout"]["shapes"] = [] if years is None else [year_span(years)]
+    return patched
+
+
+# Which outputs each input feeds. Options never depend on the species filter,
+# the species search only feeds the species options, the bar variable only
+# feeds the chart, and the year range only moves the time series' shading.
+# The map has its own callback below.
+FILTER_INPUTS = {"country", "life_stage", "sex", "species", "uncertainty", "years"}
+OPTION_OUTPUTS = {"species_options", "life_stage_options", "sex_options"}
+FILTER_OUTPUTS = {"card", "graph", "timeline", *OPTION_OUTPUTS}
+DEPENDENT_OUTPUTS = {
+    "country": FILTER_OUTPUTS,
+    "life_stage": FILTER_OUTPUTS,
+    "sex": FILTER_OUTPUTS,
+    "uncertainty": FILTER_OUTPUTS,
+    "years": FILTER_OUTPUTS - {"timeline"} | {"timeline_range"},
+    "species": {"card", "graph", "timeline"},
+    "species_search": {"species_options"},
+    "para": {"graph"},
+}
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="viewport", function_name="debounce"),
+    Output("map_viewport", "data"),
+    Input("map", "relayoutData"),
+    State("map", "figure"),
+)
+
+
+def render_map(country, life_stage, sex, species, hexsize, uncertainty, viewport_data, years=None, patch=False,
+               checkpoint=None, exact=False):
+    """Map figure, or only its hexagons as a Patch, whether it is approximate, and the timings recorded meanwhile.
+
+    Runs in the render workers, whose metrics the app process replays.
+    """
+    with metrics.capture() as records:
+        fig = update_map(country, life_stage, sex, species, hexsize, uncertainty, viewport_data, checkpoint, exact,
+                         years)
+    approximate = fig["layout"]["meta"]["sample_fraction"] < 1
+    return (map_patch(fig) if patch else fig), approximate, records
+
+
+app.clientside_callback(
+    "() => Date.now().toString(36) + Math.random().toString(36).slice(2)",
+    Output("client_id", "data"),
+    Input("client_id", "id"),
+)
+
 
 @app.callback(
     Output("map", "figure"),
+    Output("map_refine", "data"),
     Input("country", "value"),
     Input("life_stage", "value"),
     Input("sex", "value"),
     Input("species", "value"),
     Input("hexsize", "value"),
-    Input("uncertainty", "value")  # Add uncertainty as an input
+    Input("uncertainty", "value"),
+    Input("years", "value"),
+    Input("map_viewport", "data"),
+    Input("client_id", "data"),
+    running=[(Output("map_loading", "visible"), True, False)],
 )
-def update_map(country, life_stage, sex, species, hexsize, uncertainty):
-    df = data
-    if country and country != "All":
-        df = df.filter(pl.col("Country").is_in(country))
-    if life_stage and life_stage != "All":
-        df = df.filter(pl.col("LifeStage") == life_stage)
-    if sex and sex != "All":
-        df = df.filter(pl.col("Sex") == sex)
-    if species and species != "All":
-        df = df.filter(pl.col("Species") == species)
-    if uncertainty:
-        df = df.filter(pl.col("Uncertainty") <= int(uncertainty))  # Convert string to int for comparison
-
-    return ff.create_hexbin_mapbox(
-        data_frame=df,
-        lat="decimalLatitude",
-        lon="decimalLongitude",
-        nx_hexagon=int(hexsize),
-        opacity=0.4,
-        min_count=1,
-        labels={"color": "Point Count"},
-        color_continuous_scale="turbo",
-    )
+def update_map_figure(country, life_stage, sex, species, hexsize, uncertainty, years, viewport_data, client_id):
+    """Render the map in the worker pool; a hexbin size or viewport change only patches the hexagons.
+
+    A newer render for the same browser tab supersedes the one in flight, so
+    clicking through countries only finishes the last selection. An
+    approximate map hands its arguments to ``refine_map`` for the exact render.
+    """
+    triggered = set(ctx.triggered_prop_ids.values())
+    args = (country, life_stage, sex, species, hexsize, uncertainty, viewport_data, years)
+    patch = bool(triggered) and triggered <= {"hexsize", "map_viewport"}
+    if render_pool is None or client_id is None:
+        fig, approximate, records = render_map(*args, patch=patch)
+    else:
+        try:
+            fig, approximate, records = render_pool.run(client_id, render_map, *args, patch=patch)
+        except Superseded:
+            raise PreventUpdate
+    metrics.replay(records)
+    return fig, ({"args": args} if approximate else no_update)
 
 
 @app.callback(
+    Output("map", "figure", allow_duplicate=True),
+    Input("map_refine", "data"),
+    State("client_id", "data"),
+    prevent_initial_call=True,
+)
+def refine_map(refine, client_id):
+    """Replace an approximate map with the exact one, unless a newer render has started meanwhile."""
+    if not refine:
+        raise PreventUpdate
+    args = refine["args"]
+    if render_pool is None or client_id is None:
+        fig, _, records = render_map(*args, patch=True, exact=True)
+    else:
+        try:
+            fig, _, records = render_pool.run(client_id, render_map, *args, patch=True, exact=True)
+        except Superseded:
+            raise PreventUpdate
+    metrics.replay(records)
+    return fig
+
+
+def fits_client(state):
+    """Whether the rows under ``state``'s country and species are few enough to filter in the browser."""
+    if CLIENT_FILTER_MAX_ROWS <= 0:
+        return False
+    base = subset_state(state)
+    count = facet_cube.count(base)
+    if count is None:
+        count = filter_engine.count(base)
+    return count <= CLIENT_FILTER_MAX_ROWS
+
+
+def client_subset(state):
+    """Columnar subset shipped to the browser for ``state``, or None if it is too large."""
+    if not fits_client(state):
+        return None
+    return encode_subset(filter_engine.filtered(subset_state(state), columns=SUBSET_COLUMNS))
+
+
+@app.callback(
+    Output("occurrences_card", "children"),
     Output("bar_line_1", "figure"),
+    Output("species", "data"),
+    Output("life_stage", "data"),
+    Output("sex", "data"),
+    Output("client_subset", "data"),
+    Output("timeline", "figure"),
     Input("country", "value"),
     Input("life_stage", "value"),
     Input("sex", "value"),
     Input("species", "value"),
+    Input("uncertainty", "value"),
+    Input("years", "value"),
     Input("para", "value"),
-    Input("uncertainty", "value")  # Add uncertainty as an input
+    Input("species", "searchValue"),
 )
-def update_graph(country, life_stage, sex, species, para, uncertainty):
-    df = data
-    if country and country != "All":
-        df = df.filter(pl.col("Country").is_in(country))
-    if life_stage and life_stage != "All":
-        df = df.filter(pl.col("LifeStage") == life_stage)
-    if sex and sex != "All":
-        df = df.filter(pl.col("Sex") == sex)
-    if species and species != "All":
-        df = df.filter(pl.col("Species") == species)
-    if uncertainty:
-        df = df.filter(pl.col("Uncertainty") <= int(uncertainty))  # Convert string to int for comparison
+def update_dashboard(country, life_stage, sex, species, uncertainty, years, para, species_search):
+    """Recompute only the outputs that depend on the inputs that changed.
 
-    # Example graph generation based on the selected parameter
-    grouped = df.group_by(para).agg(pl.col("occurrenceID").count().alias("count"))
-    fig = px.bar(grouped.to_pandas(), x=para, y="count", title=f"{para} Occurrences")
-    return fig
+    Filter changes send a full chart; a variable change only patches the bars
+    and a year range change only the time series' shading. While the browser
+    holds the subset for the selected country and species, it recomputes the
+    card and chart itself and the server leaves them alone.
+    """
+    triggered = {"species_search" if prop == "species.searchValue" else component
+                 for prop, component in ctx.triggered_prop_ids.items()}
+    stale = set().union(*(DEPENDENT_OUTPUTS[t] for t in triggered)) if triggered else FILTER_OUTPUTS
+    state = normalize_filters(country, life_stage, sex, species, uncertainty, year_filter(years))
 
-@app.callback(
-    Output("species", "data"),
-    Output("life_stage", "data"),
-    Output("sex", "data"),
-    Input("country", "value"),
+    subset = no_update
+    if not triggered or triggered & {"country", "species"}:
+        subset = client_subset(state)
+    elif triggered <= CLIENT_INPUTS and fits_client(state):
+        stale -= {"card", "graph"}
+
+    card = graph = timeline = no_update
+    species_data = life_stage_data = sex_data = no_update
+    if "card" in stale:
+        card = update_occurrences_card(country, life_stage, sex, species, uncertainty, years)
+    if "graph" in stale:
+        graph = update_graph(country, life_stage, sex, species, para, uncertainty, years)
+        if triggered and not triggered & FILTER_INPUTS:
+            graph = graph_patch(graph)
+    if stale & OPTION_OUTPUTS:
+        options = update_selection_options(country, life_stage, sex, uncertainty, species_search, species, years)
+        species_data, life_stage_data, sex_data = (
+            data if output in stale else no_update
+            for output, data in zip(["species_options", "life_stage_options", "sex_options"], options)
+        )
+    if "timeline" in stale:
+        timeline = update_timeline(country, life_stage, sex, species, uncertainty, years)
+    elif "timeline_range" in stale:
+        timeline = timeline_patch(years)
+    return card, graph, species_data, life_stage_data, sex_data, subset, timeline
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="client_filter", function_name="update"),
+    Output("occurrences_card", "children", allow_duplicate=True),
+    Output("bar_line_1", "figure", allow_duplicate=True),
+    Input("client_subset", "data"),
     Input("life_stage", "value"),
     Input("sex", "value"),
-    Input("uncertainty", "value")  # Add uncertainty as an input
+    Input("uncertainty", "value"),
+    Input("years", "value"),
+    Input("para", "value"),
+    State("years", "min"),
+    State("years", "max"),
+    State("bar_line_1", "figure"),
+    prevent_initial_call=True,
 )
-def update_selection_options(country, life_stage, sex, uncertainty):
-    """Dynamically update species, life stage, and sex options based on filters."""
-    df = data
-
-    # Filter data based on the selected country, life stage, sex, and uncertainty
-    if country and country != "All":
-        df = df.filter(pl.col("Country").is_in(country))
-    if life_stage and life_stage != "All":
-        df = df.filter(pl.col("LifeStage") == life_stage)
-    if sex and sex != "All":
-        df = df.filter(pl.col("Sex") == sex)
-    if uncertainty:
-        df = df.filter(pl.col("Uncertainty") <= int(uncertainty))  # Convert string to int for comparison
-
-    # Update species options: replace None with 'Unknown' and sort
-    species_options = sorted(df["Species"].fill_null("Unknown").unique().to_list())
-    species_data = [{"value": s, "label": s} for s in species_options] + [{"value": "All", "label": "All"}]
-
-    # Update life stage options: replace None with 'Unknown' and sort
-    life_stage_options = sorted(df["LifeStage"].fill_null("Unknown").unique().to_list())
-    life_stage_data = [{"value": s, "label": s} for s in life_stage_options] + [{"value": "All", "label": "All"}]
-
-    # Update sex options: replace None with 'Unknown' and sort
-    sex_options = sorted(df["Sex"].fill_null("Unknown").unique().to_list())
-    sex_data = [{"value": s, "label": s} for s in sex_options] + [{"value": "All", "label": "All"}]
 
-    return species_data, life_stage_data, sex_data
+
+def prewarm_figures():
+    """Render the default map and chart, and those of the most common countries, into the shared cache.
+
+    Only the first app process to start on a dataset version does this, and
+    never a render worker.
+    """
+    if not figure_cache.claim("prewarm"):
+        return
+    start = time.perf_counter()
+    views = [[]] + [[country] for country in top_countries(FIGURE_PREWARM)]
+    for country in views:
+        # The unwrapped builders keep the prewarm out of the request metrics.
+        update_map.__wrapped__(country, "All", "All", None, DEFAULT_HEXSIZE, DEFAULT_UNCERTAINTY, exact=True)
+        update_graph.__wrapped__(country, "All", "All", None, DEFAULT_PARA, DEFAULT_UNCERTAINTY)
+    logging.getLogger(__name__).info("Prewarmed the figures of %d views in %.2fs",
+                                     len(views), time.perf_counter() - start)
+
+
+if figure_cache is not None and FIGURE_PREWARM > 0 and not in_worker():
+    threading.Thread(target=prewarm_figures, name="prewarm-figures", daemon=True).start()
 
 
 # Start Server
@@ -0,0 +1,85 @@
+// Client-side filtering of a small subset shipped by the server (see
+// client_filter.py): recounts the occurrences card and regroups the bar chart
+// when life stage, sex, uncertainty, the year range or the bar variable change.
+function labelCode(column, value) {
+    if (value === null || value === undefined || value === "" || value === "All") {
+        return null;
+    }
+    var code = column.labels.indexOf(value);
+    return code === -1 ? -2 : code;
+}
+
+// Same bars as bar_chart.top_counts: missing values as "Unknown", ordered by
+// count then label, and everything past the limit summed into "Other".
+function topBars(labels, counts, missing, limit) {
+    var totals = {};
+    labels.forEach(function (label, code) {
+        if (counts[code]) { totals[label] = (totals[label] || 0) + counts[code]; }
+    });
+    if (missing) { totals.Unknown = (totals.Unknown || 0) + missing; }
+    var bars = Object.keys(totals).map(function (label) { return [label, totals[label]]; });
+    bars.sort(function (a, b) { return b[1] - a[1] || (a[0] < b[0] ? -1 : a[0] > b[0] ? 1 : 0); });
+    if (limit <= 0 || bars.length <= limit + 1) {
+        return bars;
+    }
+    var other = bars.slice(limit).reduce(function (sum, bar) { return sum + bar[1]; }, 0);
+    return bars.slice(0, limit).concat([["Other", other]]);
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    client_filter: {
+        update: function (subset, lifeStage, sex, uncertainty, years, para, firstYear, lastYear, figure) {
+            var noUpdate = window.dash_clientside.no_update;
+            if (!subset || !figure) {
+                return [noUpdate, noUpdate];
+            }
+            var columns = subset.columns;
+            var lifeStageCode = labelCode(columns.LifeStage, lifeStage);
+            var sexCode = labelCode(columns.Sex, sex);
+            var threshold = uncertainty === null || uncertainty === undefined || uncertainty === ""
+                ? null : Number(uncertainty);
+            // Like app.year_filter: a range spanning every year keeps the rows without a year too.
+            var yearRange = years && years.length === 2
+                && (Math.min(years[0], years[1]) > firstYear || Math.max(years[0], years[1]) < lastYear)
+                ? [Math.min(years[0], years[1]), Math.max(years[0], years[1])] : null;
+            var groups = columns[para];
+            var counts = new Array(groups.labels.length).fill(0);
+            var missing = 0;
+            var total = 0;
+
+            for (var i = 0; i < subset.rows; i++) {
+                if (lifeStageCode !== null && columns.LifeStage.codes[i] !== lifeStageCode) { continue; }
+                if (sexCode !== null && columns.Sex.codes[i] !== sexCode) { continue; }
+                if (threshold !== null) {
+                    var value = columns.Uncertainty[i];
+                    if (value === null || !(value <= threshold)) { continue; }
+                }
+                if (yearRange !== null) {
+                    var year = columns.Year[i];
+                    if (year === null || year < yearRange[0] || year > yearRange[1]) { continue; }
+                }
+                var group = groups.codes[i];
+                if (group === -1) { missing++; } else { counts[group]++; }
+                total++;
+            }
+
+            var layout = figure.layout || {};
+            var bars = topBars(groups.labels, counts, missing, (layout.meta || {}).bar_limit || 0);
+            var x = bars.map(function (bar) { return bar[0]; });
+            var y = bars.map(function (bar) { return bar[1]; });
+
+            var trace = Object.assign({}, figure.data[0], {
+                x: x,
+                y: y,
+                hovertemplate: para + "=%{x}<br>count=%{y}<extra></extra>"
+            });
+            var xaxis = Object.assign({}, layout.xaxis);
+            xaxis.title = Object.assign({}, xaxis.title, {text: para});
+            var newLayout = Object.assign({}, layout, {
+                title: Object.assign({}, layout.title, {text: para + " Occurrences"}),
+                xaxis: xaxis
+            });
+            return ["Occurrences: " + total, Object.assign({}, figure, {data: [trace], layout: newLayout})];
+        }
+    }
+});
@@ -0,0 +1,30 @@
+// Debounced map viewport: turns the map's relayoutData into
+// {lat_range, lon_range, zoom, uirevision} once panning/zooming has paused,
+// so rapid pans don't queue up a server-side recompute per frame.
+var VIEWPORT_DEBOUNCE_MS = 300;
+var viewportToken = 0;
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    viewport: {
+        debounce: function (relayoutData, figure) {
+            var derived = relayoutData && relayoutData["mapbox._derived"];
+            if (!derived || !derived.coordinates) {
+                return window.dash_clientside.no_update;
+            }
+            var lons = derived.coordinates.map(function (c) { return c[0]; });
+            var lats = derived.coordinates.map(function (c) { return c[1]; });
+            var viewport = {
+                lat_range: [Math.min.apply(null, lats), Math.max.apply(null, lats)],
+                lon_range: [Math.min.apply(null, lons), Math.max.apply(null, lons)],
+                zoom: relayoutData["mapbox.zoom"],
+                uirevision: figure && figure.layout ? figure.layout.uirevision : null
+            };
+            var token = ++viewportToken;
+            return new Promise(function (resolve) {
+                setTimeout(function () {
+                    resolve(token === viewportToken ? viewport : window.dash_clientside.no_update);
+                }, VIEWPORT_DEBOUNCE_MS);
+            });
+        }
+    }
+});
@@ -0,0 +1,56 @@
+"""Bar chart of occurrence counts per value of a variable.
+
+Species and Publisher have thousands of values, so the chart shows the
+``limit`` largest ones and sums the rest into an "Other" bar. Bars are ordered
+by count, then label, so the same counts always give the same chart. The
+figure is built with ``go.Bar`` straight from the Polars columns, without the
+pandas and plotly express round trip. ``assets/client_filter.js`` regroups the
+browser-side subset the same way, reading the limit from ``layout.meta``.
+"""
+import plotly.graph_objects as go
+import polars as pl
+
+from payload import compact_figure
+
+MISSING_LABEL = "Unknown"
+OTHER_LABEL = "Other"
+
+
+def top_counts(grouped, column, limit):
+    """The ``limit`` largest groups of a ``column``/``count`` frame plus an "Other" row for the rest.
+
+    Missing values count as "Unknown". A limit of 0 keeps every group.
+    """
+    counts = (
+        grouped.lazy()
+        .with_columns(pl.col(column).cast(pl.String).fill_null(MISSING_LABEL))
+        .group_by(column)
+        .agg(pl.col("count").sum())
+        .sort(["count", column], descending=[True, False])
+        .collect()
+    )
+    # One leftover group is shown as itself rather than as "Other".
+    if limit <= 0 or counts.height <= limit + 1:
+        return counts
+    top = counts.head(limit)
+    other = pl.DataFrame({column: [OTHER_LABEL], "count": [counts["count"].slice(limit).sum()]}, schema=top.schema)
+    return pl.concat([top, other])
+
+
+def bar_figure(counts, column, limit):
+    """Figure dict of the bars in ``counts``, as returned by ``top_counts``."""
+    fig = go.Figure(
+        go.Bar(
+            x=counts[column].to_list(),
+            y=counts["count"].to_numpy(),
+            hovertemplate=f"{column}=%{{x}}<br>count=%{{y}}<extra></extra>",
+            marker={"color": "#636efa"},
+        ),
+        layout={
+            "title": {"text": f"{column} Occurrences"},
+            "xaxis": {"title": {"text": column}, "type": "category"},
+            "yaxis": {"title": {"text": "count"}},
+            "meta": {"bar_limit": limit},
+        },
+    )
+    return compact_figure(fig)
@@ -0,0 +1,413 @@
+"""Benchmark the callback hot paths on synthetic GBIF-shaped data.
+
+    python benchmark.py generate --rows 1M
+    python benchmark.py run --rows 1M 10M --output results.json
+    python benchmark.py compare baseline.json results.json
+
+``generate`` writes a parquet with the columns and rough distributions of the
+GBIF export (skewed countries and species, mostly missing life stage and sex,
+coordinates clustered per country, mostly recent summer dates). ``run``
+generates any missing files and, for each size in a fresh process, points the
+app at the file, builds the sidecars, checks that the exact map bins every
+filtered point and calls ``update_map`` (both the possibly sampled draft and,
+as ``update_map[exact]``, the exact render), ``update_graph``,
+``update_timeline``, ``update_occurrences_card`` and
+``update_selection_options`` over a matrix of filter states. Filter and option
+caches are cleared before every call, and the shared figure cache is off. The
+JSON report holds p50/p95 latency, peak RSS and the serialized (and gzipped)
+payload size per callback and state.
+``compare`` exits non-zero if any p50 got slower by more than ``--threshold``.
+"""
+import argparse
+import datetime
+import functools
+import gzip
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import polars as pl
+
+from parallel import AGG_THREADS
+
+BENCH_DIR = "./bench_data"
+CHUNK_ROWS = 1_000_000
+
+# (name, centroid latitude, centroid longitude, spread in degrees, weight)
+COUNTRIES = [
+    ("Germany", 51.2, 10.4, 2.5, 20),
+    ("United Kingdom of Great Britain and Northern Ireland", 53.0, -1.5, 2.5, 18),
+    ("Netherlands", 52.2, 5.5, 0.8, 14),
+    ("France", 46.6, 2.4, 3.0, 10),
+    ("Sweden", 60.1, 15.6, 4.0, 8),
+    ("Belgium", 50.6, 4.6, 0.7, 6),
+    ("Denmark", 56.0, 9.5, 1.2, 5),
+    ("Finland", 62.5, 25.7, 3.5, 4),
+    ("Spain", 40.2, -3.6, 3.0, 4),
+    ("United States of America", 39.5, -98.0, 12.0, 4),
+    ("Switzerland", 46.8, 8.2, 0.8, 3),
+    ("Austria", 47.5, 14.5, 1.2, 2),
+    ("Italy", 42.8, 12.5, 3.0, 2),
+    ("Poland", 52.0, 19.4, 2.5, 2),
+    ("Australia", -25.3, 133.8, 10.0, 2),
+    ("Canada", 54.0, -100.0, 10.0, 1),
+    ("Japan", 36.2, 138.3, 3.0, 1),
+    ("South Africa", -29.0, 24.7, 4.0, 1),
+    ("Brazil", -10.3, -53.2, 8.0, 1),
+    ("India", 22.0, 79.0, 6.0, 1),
+]
+N_SPECIES = 600
+N_PUBLISHERS = 80
+LIFE_STAGES = [(None, 70), ("Adult", 18), ("Imago", 5), ("Larva", 3), ("Exuviae", 3), ("Juvenile", 1)]
+SEXES = [(None, 75), ("Male", 15), ("Female", 9), ("Hermaphrodite", 1)]
+UNCERTAINTIES = [(None, 30), (1.0, 3), (5.0, 5), (10.0, 8), (30.0, 10), (50.0, 6), (100.0, 12), (250.0, 8),
+                 (1000.0, 8), (5000.0, 6), (25000.0, 4)]
+# Recording peaks in summer; some records only have a year.
+MONTHS = [(None, 5), (1, 1), (2, 1), (3, 2), (4, 5), (5, 12), (6, 18), (7, 20), (8, 18), (9, 10), (10, 5),
+          (11, 2), (12, 1)]
+HEXSIZE = 100
+UNCERTAINTY = "1000"
+
+
+def parse_rows(text):
+    """Row count from e.g. ``"200k"``, ``"10M"`` or ``"1500000"``."""
+    text = str(text).strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def rows_label(rows):
+    if rows % 1_000_000 == 0:
+        return f"{rows // 1_000_000}M"
+    return f"{rows // 1_000}k" if rows % 1_000 == 0 else str(rows)
+
+
+def bench_path(rows, directory=BENCH_DIR):
+    return os.path.join(directory, f"gbif_{rows_label(rows)}.parquet")
+
+
+def _choice(rng, weighted, n):
+    values, weights = zip(*weighted)
+    weights = np.array(weights, dtype=float)
+    return np.array(values, dtype=object)[rng.choice(len(values), n, p=weights / weights.sum())]
+
+
+def _zipf_index(rng, n_values, n, exponent=1.1):
+    weights = 1 / np.arange(1, n_values + 1) ** exponent
+    return rng.choice(n_values, n, p=weights / weights.sum())
+
+
+def _chunk(rng, start, n):
+    weights = np.array([c[4] for c in COUNTRIES], dtype=float)
+    country = rng.choice(len(COUNTRIES), n, p=weights / weights.sum())
+    lat0, lon0, spread = (np.array([c[i] for c in COUNTRIES])[country] for i in (1, 2, 3))
+    species = _zipf_index(rng, N_SPECIES, n)
+    publisher = _zipf_index(rng, N_PUBLISHERS, n, exponent=1.5)
+    ids = np.arange(start, start + n, dtype=np.int64)
+    return pl.DataFrame({
+        "gbifID": ids + 1_000_000_000,
+        "occurrenceID": pl.Series(ids).cast(pl.String).str.pad_start(10, "0"),
+        "country": pl.Series([COUNTRIES[i][0] for i in range(len(COUNTRIES))])[country],
+        "species": pl.Series([f"Odonata species {i:04d}" for i in range(N_SPECIES)])[species],
+        "lifeStage": pl.Series(_choice(rng, LIFE_STAGES, n).tolist(), dtype=pl.String),
+        "sex": pl.Series(_choice(rng, SEXES, n).tolist(), dtype=pl.String),
+        "publisher": pl.Series([f"Publisher {i:03d}" for i in range(N_PUBLISHERS)])[publisher],
+        "basisOfRecord": _choice(rng, [("HUMAN_OBSERVATION", 90), ("PRESERVED_SPECIMEN", 8),
+                                       ("MACHINE_OBSERVATION", 2)], n).tolist(),
+        "decimalLatitude": (lat0 + rng.normal(0, 1, n) * spread).clip(-85, 85),
+        "decimalLongitude": (lon0 + rng.normal(0, 1, n) * spread * 1.5).clip(-180, 180),
+        "coordinateUncertaintyInMeters": pl.Series(_choice(rng, UNCERTAINTIES, n).tolist(), dtype=pl.Float64),
+        "year": 2024 - np.minimum(rng.exponential(8, n), 60).astype(np.int64),
+        "month": pl.Series(_choice(rng, MONTHS, n).tolist(), dtype=pl.Int64),
+    })
+
+
+def generate(rows, path, seed=0):
+    """Write ``rows`` synthetic occurrences to ``path``, one row group per chunk."""
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rng = np.random.default_rng(seed)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writer = None
+    for start in range(0, rows, CHUNK_ROWS):
+        table = _chunk(rng, start, min(CHUNK_ROWS, rows - start)).to_arrow()
+        writer = writer or pq.ParquetWriter(tmp_path, table.schema)
+        writer.write_table(table)
+    writer.close()
+    os.replace(tmp_path, path)
+
+
+class PeakMemory:
+    """Samples the process RSS while the block runs; ``peak_mb`` and ``delta_mb`` afterwards."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.start = self.peak = self.rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+        self.peak_mb = self.peak / 1e6
+        self.delta_mb = (self.peak - self.start) / 1e6
+
+
+def filter_cases(data):
+    """Named filter states covering the pyramid, cube, index and raw-scan paths."""
+    def top(column, n=1, rare=False):
+        counts = data.lazy().group_by(column).len().drop_nulls().sort("len", descending=not rare).collect()
+        return counts[column].cast(pl.String).head(n).to_list()
+
+    country, second_country = top("Country", 2)
+    species, rare_species = top("Species")[0], top("Species", rare=True)[0]
+    life_stage = top("LifeStage")[0]
+    last_year = data.lazy().select(pl.col("Year").max()).collect().item()
+    return {
+        "all": dict(country=[], life_stage="All", sex="All", species=None),
+        "country": dict(country=[country], life_stage="All", sex="All", species=None),
+        "two_countries": dict(country=[country, second_country], life_stage="All", sex="All", species=None),
+        "country_life_stage_sex": dict(country=[country], life_stage=life_stage, sex="Male", species=None),
+        "species": dict(country=[], life_stage="All", sex="All", species=species),
+        "rare_species": dict(country=[], life_stage="All", sex="All", species=rare_species),
+        "country_species": dict(country=[country], life_stage="All", sex="All", species=species),
+        "country_decade": dict(country=[country], life_stage="All", sex="All", species=None,
+                               years=[last_year - 9, last_year] if last_year is not None else None),
+    }
+
+
+def _payload_bytes(value):
+    from dash._utils import to_json
+
+    body = to_json(value).encode()
+    return len(body), len(gzip.compress(body, 6))
+
+
+def _time_calls(fn, args, repeat, clear):
+    timings, result = [], None
+    with PeakMemory() as memory:
+        for _ in range(repeat):
+            clear()
+            start = time.perf_counter()
+            result = fn(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+    payload, payload_gzip = _payload_bytes(result)
+    return {
+        "runs": repeat,
+        "first_ms": round(timings[0], 3),
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(float(np.percentile(timings, 95)), 3),
+        "peak_rss_mb": round(memory.peak_mb, 1),
+        "rss_delta_mb": round(memory.delta_mb, 1),
+        "payload_bytes": payload,
+        "payload_gzip_bytes": payload_gzip,
+    }
+
+
+def _build_sidecars(source):
+    from bitmap_index import build_index, index_paths
+    from data import load_data
+    from pyramid import DEFAULT_LEVELS, build_pyramid, pyramid_path, write_pyramid
+
+    table, extent = build_pyramid(load_data("lazy", source), DEFAULT_LEVELS)
+    write_pyramid(table, extent, list(DEFAULT_LEVELS), pyramid_path(source), source)
+    build_index(load_data("eager", source), *index_paths(source), source)
+
+
+def check_map_total(app, state, hexsize=HEXSIZE):
+    """Raise if the exact raw-path map of ``state`` does not bin every point counted by the filter engine."""
+    from hexbin import LAT, LON, compute_hexbin
+
+    df = app.filter_engine.filtered(state, columns=[LAT, LON])
+    count = app.filter_engine.count(state)
+    bins = compute_hexbin(df, hexsize)
+    total = 0 if bins is None else int(bins.counts.sum())
+    if total != count:
+        raise AssertionError(f"map total {total} differs from the count {count} for {state}")
+
+
+def measure(source, repeat, sidecars=True):
+    """Benchmark the callbacks of the app loaded on ``source``; returns the report dict."""
+    os.environ["GBIF_DATA_PATH"] = source
+    os.environ["GBIF_MAP_WORKERS"] = "0"
+    os.environ["GBIF_OPTIONS_PREWARM"] = "0"
+    os.environ["GBIF_FIGURE_CACHE_MB"] = "0"
+    os.environ.setdefault("MAPBOX_TOKEN", "benchmark")
+    if sidecars:
+        _build_sidecars(source)
+
+    start = time.perf_counter()
+    with PeakMemory() as memory:
+        import app
+    startup = {"startup_s": round(time.perf_counter() - start, 3), "startup_peak_rss_mb": round(memory.peak_mb, 1)}
+
+    from filter_engine import normalize_filters
+
+    def clear():
+        app.filter_engine.cache_clear()
+        app.facet_values.cache_clear()
+
+    results = []
+    for case, filters in filter_cases(app.data).items():
+        country, life_stage, sex, species = filters["country"], filters["life_stage"], filters["sex"], filters["species"]
+        years = filters.get("years")
+        check_map_total(app, normalize_filters(country, life_stage, sex, species, UNCERTAINTY, app.year_filter(years)))
+        calls = {
+            "update_occurrences_card": (app.update_occurrences_card,
+                                        (country, life_stage, sex, species, UNCERTAINTY, years)),
+            "update_map": (functools.partial(app.update_map, years=years),
+                           (country, life_stage, sex, species, HEXSIZE, UNCERTAINTY, None)),
+            "update_map[exact]": (functools.partial(app.update_map, exact=True, years=years),
+                                  (country, life_stage, sex, species, HEXSIZE, UNCERTAINTY, None)),
+            "update_graph[Country]": (app.update_graph,
+                                      (country, life_stage, sex, species, "Country", UNCERTAINTY, years)),
+            "update_graph[Species]": (app.update_graph,
+                                      (country, life_stage, sex, species, "Species", UNCERTAINTY, years)),
+            "update_timeline": (app.update_timeline, (country, life_stage, sex, species, UNCERTAINTY, years)),
+            "update_selection_options": (functools.partial(app.update_selection_options, years=years),
+                                         (country, life_stage, sex, UNCERTAINTY)),
+        }
+        for callback, (fn, args) in calls.items():
+            results.append({"callback": callback, "case": case, **_time_calls(fn, args, repeat, clear)})
+            print(f"{callback:<26}{case:<24}{results[-1]['p50_ms']:>10.1f} ms", file=sys.stderr)
+
+    return {
+        "source": source,
+        "rows": app.data.height if hasattr(app.data, "height") else None,
+        "data_mode": app.DATA_MODE,
+        "sidecars": sidecars,
+        **startup,
+        "results": results,
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "polars_threads": pl.thread_pool_size(),
+        "agg_threads": AGG_THREADS,
+    }
+
+
+def run(sizes, repeat, directory, sidecars):
+    """Benchmark every size in its own process, generating missing files first."""
+    runs = []
+    for rows in sizes:
+        path = bench_path(rows, directory)
+        if not os.path.exists(path):
+            print(f"Generating {rows:,} rows to {path}", file=sys.stderr)
+            generate(rows, path)
+        command = [sys.executable, os.path.abspath(__file__), "measure", "--source", path, "--repeat", str(repeat)]
+        if not sidecars:
+            command.append("--no-sidecars")
+        output = subprocess.run(command, check=True, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+        sys.stderr.write(output.stderr)
+        runs.append(json.loads(output.stdout))
+    return {"environment": _environment(), "repeat": repeat, "runs": runs}
+
+
+def compare(baseline, current, threshold):
+    """Print p50 changes between two reports; returns the regressions beyond ``threshold``."""
+    def index(report):
+        return {
+            (run["rows"], result["callback"], result["case"]): result
+            for run in report["runs"] for result in run["results"]
+        }
+
+    old, new = index(baseline), index(current)
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]["p50_ms"] / max(old[key]["p50_ms"], 1e-3)
+        flag = "REGRESSION" if ratio > threshold else ""
+        print(f"{rows_label(key[0]):>5} {key[1]:<26}{key[2]:<24}{old[key]['p50_ms']:>10.1f}"
+              f"{new[key]['p50_ms']:>10.1f}{ratio:>8.2f}x {flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="Write a synthetic GBIF-shaped parquet.")
+    generate_parser.add_argument("--rows", default="1M")
+    generate_parser.add_argument("--output", default=None, help=f"Default: {BENCH_DIR}/gbif_<rows>.parquet")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = commands.add_parser("run", help="Benchmark the callbacks at one or more dataset sizes.")
+    run_parser.add_argument("--rows", nargs="+", default=["1M"])
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--dir", default=BENCH_DIR, help="Where generated datasets are kept.")
+    run_parser.add_argument("--no-sidecars", dest="sidecars", action="store_false",
+                            help="Do not build the hexbin pyramid and bitmap index.")
+    run_parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout.")
+
+    measure_parser = commands.add_parser("measure", help="Benchmark one dataset in this process (used by run).")
+    measure_parser.add_argument("--source", required=True)
+    measure_parser.add_argument("--repeat", type=int, default=5)
+    measure_parser.add_argument("--no-sidecars", dest="sidecars", action="store_false")
+
+    compare_parser = commands.add_parser("compare", help="Compare two reports and fail on p50 regressions.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=1.2)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        rows = parse_rows(args.rows)
+        generate(rows, args.output or bench_path(rows), args.seed)
+    elif args.command == "measure":
+        json.dump(measure(args.source, args.repeat, args.sidecars), sys.stdout)
+    elif args.command == "run":
+        report = run([parse_rows(rows) for rows in args.rows], args.repeat, args.dir, args.sidecars)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
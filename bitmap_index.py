@@ -0,0 +1,191 @@
+"""Inverted row index for the filter dimensions.
+
+For every distinct Country, LifeStage, Sex and Species value, and for every
+uncertainty threshold of the dropdown and every year, the index stores the
+set of matching row positions. Like roaring bitmaps, each set is kept in whichever container
+is smaller: a packed bitmap (one bit per row) for frequent values or a sorted
+``uint32`` array of row ids for rare ones. A filter state then resolves by
+OR-ing the sets within a dimension (the years of a year range) and AND-ing
+across dimensions, without touching the columns.
+
+The containers live in one flat file next to the parquet with a JSON manifest,
+and are memory-mapped at startup. Build them with::
+
+    python bitmap_index.py
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import polars as pl
+
+from data import DATA_PATH, FRAME_VERSION, load_data, source_stamp
+from filter_engine import UNCERTAINTY_BUCKETS, bucket_filter_supported
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = {"country": "Country", "life_stage": "LifeStage", "sex": "Sex", "species": "Species"}
+DENSE, SPARSE = "dense", "sparse"
+
+
+def index_paths(source=DATA_PATH):
+    """Container file and manifest locations for ``source``."""
+    root, _ = os.path.splitext(source)
+    return root + ".bitmaps", root + ".bitmaps.json"
+
+
+def _container(ids, n_rows):
+    """Smallest encoding of a sorted row-id array: (kind, uint8 buffer)."""
+    if len(ids) * 32 < n_rows:
+        return SPARSE, ids.astype(np.uint32).view(np.uint8)
+    mask = np.zeros(n_rows, dtype=bool)
+    mask[ids] = True
+    return DENSE, np.packbits(mask)
+
+
+def _value_row_ids(column):
+    """Map each non-null value of ``column`` to the sorted positions of its rows."""
+    if not isinstance(column.dtype, pl.Enum):
+        labels = sorted(column.drop_nulls().cast(pl.String).unique().to_list())
+        column = column.cast(pl.String).cast(pl.Enum(labels))
+    labels = column.dtype.categories.to_list()
+    physical = column.to_physical()
+    valid = physical.is_not_null().to_numpy()
+    codes = physical.fill_null(0).to_numpy().astype(np.int64)[valid]
+    order = np.flatnonzero(valid)[np.argsort(codes, kind="stable")]
+    counts = np.bincount(codes, minlength=len(labels))
+    return {
+        labels[code]: ids
+        for code, ids in enumerate(np.split(order, np.cumsum(counts)[:-1]))
+        if len(ids)
+    }
+
+
+def build_index(data, path, manifest_path, source=DATA_PATH):
+    """Write the containers for ``data`` to ``path`` and their directory to ``manifest_path``."""
+    n_rows = data.height
+    sets = {column: _value_row_ids(data[column]) for column in DIMENSIONS.values()}
+    uncertainty = data["Uncertainty"].to_numpy()
+    sets["Uncertainty"] = {
+        str(threshold): np.flatnonzero(uncertainty <= threshold) for threshold in UNCERTAINTY_BUCKETS
+    }
+    sets["Year"] = _value_row_ids(data["Year"])
+
+    directory, offset = {}, 0
+    with open(path, "wb") as out:
+        for column, values in sets.items():
+            directory[column] = {}
+            for value, ids in values.items():
+                kind, buffer = _container(ids, n_rows)
+                padding = -offset % 8
+                out.write(b"\0" * padding)
+                offset += padding
+                out.write(buffer.tobytes())
+                directory[column][value] = [kind, offset, len(buffer)]
+                offset += len(buffer)
+
+    with open(manifest_path, "w") as f:
+        json.dump({"n_rows": n_rows, "frame_version": FRAME_VERSION, "containers": directory,
+                   **source_stamp(source)}, f)
+
+
+class BitmapIndex:
+    """Memory-mapped row index answering filter states with sorted row ids."""
+
+    def __init__(self, buffer, directory, n_rows):
+        self.buffer = buffer
+        self.directory = directory
+        self.n_rows = n_rows
+
+    @classmethod
+    def load(cls, source=DATA_PATH, n_rows=None):
+        """Memory-map the index for ``source``; returns None if missing, stale or for another row count or order."""
+        path, manifest_path = index_paths(source)
+        if not os.path.exists(manifest_path):
+            logger.info("No bitmap index at %s, filters scan the columns.", path)
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        stamp = {key: manifest[key] for key in ("source_size", "source_mtime_ns")}
+        if (os.path.exists(source) and source_stamp(source) != stamp) or (
+            n_rows is not None and manifest["n_rows"] != n_rows
+        ) or manifest.get("frame_version") != FRAME_VERSION:
+            logger.warning("Bitmap index %s is stale for %s, ignoring it. Rebuild with `python bitmap_index.py`.",
+                           path, source)
+            return None
+        buffer = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, np.uint8)
+        return cls(buffer, manifest["containers"], manifest["n_rows"])
+
+    def _container(self, column, value):
+        entry = self.directory[column].get(value)
+        if entry is None:
+            return SPARSE, np.zeros(0, dtype=np.uint32)
+        kind, offset, length = entry
+        view = self.buffer[offset:offset + length]
+        return kind, view.view(np.uint32) if kind == SPARSE else view
+
+    def _union(self, containers):
+        if len(containers) == 1:
+            return containers[0]
+        if all(kind == SPARSE for kind, _ in containers):
+            return SPARSE, np.unique(np.concatenate([ids for _, ids in containers]))
+        packed = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        for kind, values in containers:
+            if kind == DENSE:
+                packed |= values
+            else:
+                np.bitwise_or.at(packed, values >> 3, (128 >> (values & 7)).astype(np.uint8))
+        return DENSE, packed
+
+    def _intersect(self, sets):
+        dense = [values for kind, values in sets if kind == DENSE]
+        sparse = sorted((values for kind, values in sets if kind == SPARSE), key=len)
+        if sparse:
+            ids = sparse[0]
+            for other in sparse[1:]:
+                ids = np.intersect1d(ids, other, assume_unique=True)
+            for packed in dense:
+                ids = ids[(packed[ids >> 3] >> (7 - (ids & 7)).astype(np.uint8)) & 1 == 1]
+            return ids.astype(np.int64)
+        packed = np.bitwise_and.reduce(dense) if len(dense) > 1 else dense[0]
+        return np.flatnonzero(np.unpackbits(packed, count=self.n_rows))
+
+    def rows(self, state):
+        """Sorted positions of the rows matching ``state``, or None if the index cannot answer it."""
+        if not bucket_filter_supported(state):
+            return None
+        sets = []
+        for field, column in DIMENSIONS.items():
+            value = getattr(state, field)
+            if not value:
+                continue
+            labels = value if isinstance(value, tuple) else (value,)
+            sets.append(self._union([self._container(column, label) for label in labels]))
+        if state.uncertainty is not None:
+            sets.append(self._container("Uncertainty", str(state.uncertainty)))
+        if state.years is not None:
+            first, last = state.years
+            sets.append(self._union([self._container("Year", str(year)) for year in range(first, last + 1)]))
+        if not sets:
+            return None
+        return self._intersect(sets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the bitmap row index for the filter dimensions.")
+    parser.add_argument("--source", default=DATA_PATH, help="Source parquet file.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    data = load_data("eager", args.source)
+    path, manifest_path = index_paths(args.source)
+    build_index(data, path, manifest_path, args.source)
+    print(f"Wrote bitmap index for {data.height} rows to {path} "
+          f"({os.path.getsize(path) / 1e6:.1f} MB) in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Client-side filtering mode for small subsets.
+
+Country and species are the filters that narrow the data the most. When the
+rows matching them fit under a threshold, the server ships that subset once,
+in columnar form, to a ``dcc.Store``; the occurrences card and the bar chart
+are then recomputed in the browser (``assets/client_filter.js``) as life
+stage, sex, uncertainty, the year range or the bar variable change, without a
+round trip. The year range is left out of the shipped subset so that dragging
+the year slider never re-sends it. The server takes over again as soon as
+country or species make the subset too large.
+
+Label columns are dictionary-encoded per subset: ``{"labels": [...],
+"codes": [...]}`` with ``-1`` for missing values; ``Uncertainty`` and ``Year``
+are plain lists with nulls.
+"""
+import polars as pl
+
+from filter_engine import FilterState
+
+LABEL_COLUMNS = ["Country", "Species", "Sex", "LifeStage", "Publisher"]
+# Inputs the browser can apply to a shipped subset on its own.
+CLIENT_INPUTS = {"life_stage", "sex", "uncertainty", "years", "para"}
+# Columns of the shipped subset.
+SUBSET_COLUMNS = [*LABEL_COLUMNS, "Uncertainty", "Year"]
+
+
+def subset_state(state):
+    """The part of ``state`` the server applies before shipping a subset."""
+    return FilterState(country=state.country, species=state.species)
+
+
+def encode_subset(df):
+    """Columnar, dictionary-encoded form of ``df`` for the browser."""
+    columns = {}
+    for column in LABEL_COLUMNS:
+        values = df[column].cast(pl.String)
+        labels = sorted(values.drop_nulls().unique().to_list())
+        codes = values.cast(pl.Enum(labels)).to_physical().cast(pl.Int32).fill_null(-1)
+        columns[column] = {"labels": labels, "codes": codes.to_list()}
+    columns["Uncertainty"] = df["Uncertainty"].cast(pl.Float64).fill_nan(None).to_list()
+    columns["Year"] = df["Year"].to_list()
+    return {"rows": df.height, "columns": columns}
@@ -0,0 +1,122 @@
+"""Pre-aggregated facet count cube.
+
+The occurrences card, the bar chart and the dropdown option lists only ever
+need row counts over the filter dimensions. The cube holds one row per
+distinct Country x Species x Sex x LifeStage x Publisher x uncertainty bucket
+combination with its occurrence count, so those answers come from a small
+group-by over the cube instead of a scan of the raw rows. The dimensions keep
+the dictionary encoding of the loaded data.
+
+A second, time cube counts Country x Sex x LifeStage x uncertainty bucket
+combinations per Year and Month. It answers the time series and the queries
+with a year range. Species and Publisher are left out of it: with them it
+would have nearly as many rows as the raw data, so a year range combined with
+a species filter or a Species or Publisher chart falls back to the raw rows.
+"""
+import logging
+import time
+
+import polars as pl
+
+from filter_engine import bucket_expr, bucket_filter_supported, build_bucket_filter_expr, enum_codes
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ["Country", "Species", "Sex", "LifeStage", "Publisher"]
+TIME_DIMENSIONS = ["Country", "Sex", "LifeStage", "Year", "Month"]
+
+
+def build_cube(data, dimensions=DIMENSIONS, engine="auto"):
+    """Count rows per combination of ``dimensions`` and uncertainty bucket.
+
+    Pass ``engine="streaming"`` to count a scan without loading its rows.
+    """
+    return (
+        data.lazy()
+        .group_by([*dimensions, bucket_expr()])
+        .agg(pl.len().cast(pl.UInt32).alias("count"))
+        .collect(engine=engine)
+    )
+
+
+class FacetCube:
+    """Answers counts, per-facet counts and option lists from the cube.
+
+    Every query returns None when the filter state cannot be expressed on the
+    cube (an uncertainty threshold that is not one of the buckets, or a year
+    range without a ``time_table`` or with a species filter or column the time
+    cube leaves out), in which case callers fall back to the raw rows.
+    """
+
+    def __init__(self, table, time_table=None):
+        self.table = table
+        self.time_table = time_table
+        self.codes = enum_codes(table.schema)
+
+    @classmethod
+    def from_data(cls, data):
+        start = time.perf_counter()
+        engine = "streaming" if isinstance(data, pl.LazyFrame) else "auto"
+        cube = cls(build_cube(data, engine=engine), build_cube(data, TIME_DIMENSIONS, engine))
+        logger.info("Built facet cube with %d rows and time cube with %d rows in %.2fs",
+                    cube.table.height, cube.time_table.height, time.perf_counter() - start)
+        return cube
+
+    def _rows(self, state, by_time=False, column=None):
+        if not bucket_filter_supported(state):
+            return None
+        table = self.table
+        if by_time or state.years is not None:
+            table = self.time_table
+            if table is None or state.species is not None or (column is not None and column not in table.columns):
+                return None
+        expr = build_bucket_filter_expr(state, self.codes)
+        return table.lazy() if expr is None else table.lazy().filter(expr)
+
+    def count(self, state):
+        """Number of occurrences matching ``state``."""
+        rows = self._rows(state)
+        if rows is None:
+            return None
+        return rows.select(pl.col("count").sum()).collect().item()
+
+    def group_counts(self, state, column):
+        """Occurrences per value of ``column``, as a frame with ``column`` and ``count``."""
+        rows = self._rows(state, column=column)
+        if rows is None:
+            return None
+        return (
+            rows.group_by(column)
+            .agg(pl.col("count").sum())
+            .with_columns(pl.col(column).cast(pl.String))
+            .collect()
+        )
+
+    def month_counts(self, state):
+        """Occurrences per known ``Year`` and ``Month`` (null when unknown), sorted by time."""
+        rows = self._rows(state, by_time=True)
+        if rows is None:
+            return None
+        return (
+            rows.filter(pl.col("Year").is_not_null())
+            .group_by(["Year", "Month"])
+            .agg(pl.col("count").sum())
+            .sort(["Year", "Month"], nulls_last=True)
+            .collect()
+        )
+
+    def year_range(self):
+        """First and last year with occurrences, or None if no occurrence has a year."""
+        if self.time_table is None:
+            return None
+        first, last = self.time_table.select(pl.col("Year").min().alias("first"),
+                                             pl.col("Year").max().alias("last")).row(0)
+        return None if first is None else (first, last)
+
+    def options(self, state, column):
+        """Sorted values of ``column`` present under ``state``, with missing values as "Unknown"."""
+        rows = self._rows(state, column=column)
+        if rows is None:
+            return None
+        values = rows.select(pl.col(column).cast(pl.String).fill_null("Unknown").unique()).collect()
+        return sorted(values[column].to_list())
@@ -0,0 +1,214 @@
+"""Loading and preprocessing of the dragonfly occurrence dataset."""
+import logging
+import os
+import time
+
+import polars as pl
+
+from dataset import PartitionedDataset, dataset_files, dataset_stamp
+from spatial import QUADKEY, quadkey_expr
+
+logger = logging.getLogger(__name__)
+
+# A parquet file or a directory of hive-partitioned parquet files (see dataset.py).
+DATA_PATH = os.path.normpath(os.environ.get("GBIF_DATA_PATH", "./data/dragonfly_database.parquet"))
+# Columns of the GBIF export the app reads, as named in the source parquet.
+SOURCE_COLUMNS = ["gbifID", "occurrenceID", "country", "species", "lifeStage", "sex", "publisher",
+                  "basisOfRecord", "decimalLatitude", "decimalLongitude", "coordinateUncertaintyInMeters"]
+# When the occurrence was recorded; read if the source has them (see ``temporal_exprs``).
+TEMPORAL_COLUMNS = ["year", "month", "eventDate"]
+# Bump whenever load_data() changes the frame it produces; row positions and
+# files derived from the frame are keyed by it.
+FRAME_VERSION = 3
+# Low-cardinality label columns held as dictionary-encoded Enums in eager frames.
+CATEGORICAL_COLUMNS = ["Country", "Species", "LifeStage", "Sex", "Publisher"]
+
+
+def scan_source(path=DATA_PATH, files=None):
+    """scan_parquet over the source file, or over ``files`` (default all) of a partitioned dataset."""
+    if os.path.isdir(path):
+        return pl.scan_parquet(dataset_files(path) if files is None else files, hive_partitioning=True)
+    return pl.scan_parquet(path)
+
+
+def source_columns(lf):
+    """SOURCE_COLUMNS plus whichever TEMPORAL_COLUMNS the source behind ``lf`` has."""
+    names = lf.collect_schema().names()
+    return SOURCE_COLUMNS + [column for column in TEMPORAL_COLUMNS if column in names]
+
+
+def temporal_exprs(columns):
+    """``Year`` (Int16) and ``Month`` (Int8) from the ``year``/``month`` columns, else from ``eventDate``.
+
+    ``eventDate`` is ISO 8601 and may be a date, a year-month or an interval;
+    its leading year and month are used. Either is null when unknown.
+    """
+    date = pl.col("eventDate").cast(pl.String).str.strip_chars() if "eventDate" in columns else None
+
+    def part(column, start, length, dtype, low, high):
+        values = [pl.col(column).cast(dtype, strict=False)] if column in columns else []
+        if date is not None:
+            values.append(date.str.slice(start, length).cast(dtype, strict=False))
+        value = pl.coalesce(values) if values else pl.lit(None, dtype)
+        return pl.when(value.is_between(low, high)).then(value).cast(dtype)
+
+    return [part("year", 0, 4, pl.Int16, 1, 9999).alias("Year"), part("month", 5, 2, pl.Int8, 1, 12).alias("Month")]
+
+
+def load_data(mode="eager", path=DATA_PATH, encode=True, files=None):
+    """Load and preprocess the dataset.
+
+    ``mode="eager"`` reads the parquet into memory; ``mode="lazy"`` keeps a
+    scan_parquet LazyFrame so filters and projections are pushed into the scan;
+    ``mode="mmap"`` memory-maps a preprocessed Arrow IPC copy shared by all
+    worker processes (see ``load_mapped``). With ``encode`` the label columns
+    of eager frames are dictionary-encoded (see ``encode_categoricals``); lazy
+    frames keep plain strings, since a Categorical cast between the scan and
+    the filter stops Polars from pushing label predicates into the scan.
+    ``path`` may be a partitioned dataset directory, and ``files`` restricts a
+    lazy scan to some of its files.
+
+    Eager frames get a ``Quadkey`` spatial key (see ``spatial``) and are
+    sorted by it so filtered subsets stay in key order. Lazy frames have no
+    key column, as Polars cannot push filters past its ``map_batches``; the
+    ``FilterEngine`` adds it to the filtered rows that ask for it. The
+    ``Year`` and ``Month`` of each occurrence replace GBIF's date columns.
+    """
+    if mode == "mmap":
+        return load_mapped(path)
+    columns = source_columns(scan_source(path, files))
+    if mode == "eager" and not os.path.isdir(path):
+        data = pl.read_parquet(path, columns=columns)
+    elif mode == "eager":
+        data = scan_source(path).select(columns).collect()
+    elif mode == "lazy":
+        data = scan_source(path, files).select(columns)
+    else:
+        raise ValueError(f"Unknown data mode {mode!r}, expected 'eager', 'lazy' or 'mmap'.")
+    data = data.rename({
+        "species": "Species",
+        "sex": "Sex",
+        "lifeStage": "LifeStage",
+        "publisher": "Publisher",
+        "country": "Country",
+        "coordinateUncertaintyInMeters" : "Uncertainty"
+    })
+    data = data.with_columns(
+    [
+        pl.col("LifeStage").cast(str),
+        pl.col("Sex").cast(str),
+        pl.col("Species").cast(str),
+        *temporal_exprs(columns),
+    ]
+    ).drop([column for column in TEMPORAL_COLUMNS if column in columns])
+    if isinstance(data, pl.LazyFrame):
+        return data
+    data = data.with_columns(quadkey_expr("decimalLatitude", "decimalLongitude")).sort(QUADKEY, nulls_last=True)
+    if encode:
+        data = encode_categoricals(data)
+    return data
+
+
+def encode_categoricals(data):
+    """Dictionary-encode the label columns of an eager frame.
+
+    Each column gets an Enum whose categories are the sorted distinct labels,
+    so codes are stable and filters can compare integer codes (see
+    ``filter_engine.enum_codes``).
+    """
+    return data.with_columns([
+        pl.col(column).cast(pl.Enum(sorted(data[column].drop_nulls().unique().to_list())))
+        for column in CATEGORICAL_COLUMNS
+    ])
+
+
+def column_options(data, column):
+    """Sorted distinct values of a column, with missing values shown as "Unknown"."""
+    values = data.lazy().select(pl.col(column).cast(pl.String).fill_null("Unknown").unique()).collect()
+    return sorted(values[column].to_list())
+
+
+def partition_scanner(path=DATA_PATH, encode=True):
+    """Function giving the lazy frame over just the files a FilterState can match, or None for a single file.
+
+    The function returns None when no file can match.
+    """
+    if not os.path.isdir(path):
+        return None
+    dataset = PartitionedDataset(path)
+
+    def scan(state):
+        files = dataset.prune(state.country, state.species)
+        if not files:
+            return None
+        logger.debug("Scanning %d of %d files for %s", len(files), len(dataset.files), state)
+        return load_data("lazy", path, encode, files=files)
+
+    return scan
+
+
+def source_stamp(path=DATA_PATH):
+    """Size and mtime of the source file, recorded by derived artifacts to detect staleness.
+
+    For a partitioned dataset these are the total size and newest mtime of its files.
+    """
+    if os.path.isdir(path):
+        return dataset_stamp(path)
+    stat = os.stat(path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def ipc_path(source=DATA_PATH):
+    """Location of the memory-mappable Arrow IPC copy of ``source``."""
+    root, _ = os.path.splitext(source)
+    return f"{root}.v{FRAME_VERSION}.arrow"
+
+
+def build_ipc(source=DATA_PATH, path=None):
+    """Write the preprocessed dataset as uncompressed Arrow IPC so it can be mapped zero-copy."""
+    path = path or ipc_path(source)
+    start = time.perf_counter()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    load_data("eager", source).write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+    logger.info("Converted %s to %s in %.1fs", source, path, time.perf_counter() - start)
+
+
+def _memory_status():
+    """Resident set of this process in bytes, split into anonymous and file-backed pages (Linux only)."""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None
+    return {key: int(fields[key].split()[0]) * 1024 for key in ("VmRSS", "RssAnon", "RssFile")}
+
+
+def load_mapped(source=DATA_PATH):
+    """Memory-map the Arrow IPC copy of ``source``, converting it first if missing or stale.
+
+    The columns are views into the mapped file, so every gunicorn worker shares
+    the same page-cache pages instead of holding its own copy of the dataset.
+    The first worker to start does the conversion while the others wait on a
+    lock file.
+    """
+    import fcntl
+
+    import pyarrow as pa
+
+    path = ipc_path(source)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path) or os.stat(path).st_mtime_ns < source_stamp(source)["source_mtime_ns"]:
+            build_ipc(source, path)
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    data = pl.from_arrow(table, rechunk=False)
+
+    memory = _memory_status()
+    if memory is not None:
+        logger.info("Memory-mapped %s: %.0f MB mapped, %.0f MB resident (%.0f MB anonymous, %.0f MB file-backed)",
+                    path, os.path.getsize(path) / 1e6, memory["VmRSS"] / 1e6,
+                    memory["RssAnon"] / 1e6, memory["RssFile"] / 1e6)
+    else:
+        logger.info("Memory-mapped %s: %.0f MB mapped", path, os.path.getsize(path) / 1e6)
+    return data
@@ -0,0 +1,177 @@
+"""Hive-partitioned multi-file datasets.
+
+``GBIF_DATA_PATH`` may point at a directory of parquet files laid out as hive
+partitions, for example::
+
+    data/odonata/country=Germany/family=Aeshnidae/part-20240101T120000-0.parquet
+
+Every ``key=value`` directory is a partition column. Country and Species
+filters select the files to scan before anything is read: a ``country``
+partition is matched against the Country filter, and a per-file catalogue of
+the species each file holds (``_species.json`` in the dataset root, extended
+with just the new files when some appear) prunes on Species whatever the
+layout. Partitioning by family keeps every species in one branch of the tree.
+
+New GBIF download chunks are added by dropping files into the tree, or with::
+
+    python dataset.py add download.parquet data/odonata --by country family
+
+which writes new part files next to the existing ones and never rewrites
+them. The app picks them up on its next start; the derived files (snapshot,
+pyramid, bitmap index) notice the changed stamp and are rebuilt or ignored as
+for a single file.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from urllib.parse import quote, unquote
+
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = "_species.json"
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def dataset_files(root):
+    """Parquet files under ``root``, sorted by path relative to it."""
+    files = []
+    for directory, subdirectories, names in os.walk(root):
+        subdirectories[:] = sorted(d for d in subdirectories if not d.startswith((".", "_")))
+        files.extend(os.path.join(directory, name) for name in names
+                     if name.endswith(".parquet") and not name.startswith((".", "_")))
+    return sorted(files, key=lambda path: os.path.relpath(path, root))
+
+
+def partition_values(root, path):
+    """Hive partition columns of ``path``, e.g. ``{"country": "Germany"}``; missing values are None."""
+    values = {}
+    for part in os.path.relpath(os.path.dirname(path), root).split(os.sep):
+        key, sep, value = part.partition("=")
+        if sep:
+            value = unquote(value)
+            values[key] = None if value == DEFAULT_PARTITION else value
+    return values
+
+
+def dataset_stamp(root):
+    """Total size and newest mtime of the dataset's files, like ``data.source_stamp`` for one file."""
+    size, mtime_ns = 0, 0
+    for path in dataset_files(root):
+        stat = os.stat(path)
+        size += stat.st_size
+        mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return {"source_size": size, "source_mtime_ns": mtime_ns}
+
+
+def dataset_sha256(root, chunk_size=8 * 1024 * 1024):
+    """SHA-256 over the relative paths and contents of the dataset's files."""
+    digest = hashlib.sha256()
+    for path in dataset_files(root):
+        digest.update(os.path.relpath(path, root).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PartitionedDataset:
+    """Files of a hive-partitioned dataset and the partitions they belong to."""
+
+    def __init__(self, root):
+        self.root = root
+        self.files = dataset_files(root)
+        if not self.files:
+            raise FileNotFoundError(f"No parquet files under {root}.")
+        self.partitions = {path: partition_values(root, path) for path in self.files}
+        self.species = self._species_catalog()
+
+    def _species_catalog(self):
+        """Species held by each file, read once per new or changed file and cached in the dataset root."""
+        catalog_path = os.path.join(self.root, CATALOG_NAME)
+        try:
+            with open(catalog_path) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = {}
+
+        start = time.perf_counter()
+        fresh, added = {}, 0
+        for path in self.files:
+            name = os.path.relpath(path, self.root)
+            stat = os.stat(path)
+            entry = catalog.get(name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                species = pl.scan_parquet(path).select(pl.col("species").unique()).collect()["species"]
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                         "species": sorted(species.drop_nulls().to_list())}
+                added += 1
+            fresh[name] = entry
+
+        if added or len(fresh) != len(catalog):
+            tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(fresh, f)
+            os.replace(tmp_path, catalog_path)
+            logger.info("Catalogued the species of %d new or changed files of %s in %.1fs",
+                        added, self.root, time.perf_counter() - start)
+        return {os.path.join(self.root, name): set(entry["species"]) for name, entry in fresh.items()}
+
+    def prune(self, countries=(), species=None):
+        """Files that can hold rows of ``countries`` (any if empty) and ``species`` (any if None)."""
+        files = self.files
+        if countries:
+            wanted = set(countries)
+            files = [path for path in files
+                     if "country" not in self.partitions[path] or self.partitions[path]["country"] in wanted]
+        if species is not None:
+            files = [path for path in files if species in self.species[path]]
+        return files
+
+
+def add_files(source, root, by, name=None):
+    """Split ``source`` by the ``by`` columns into new part files under ``root``.
+
+    Each partition is streamed from ``source`` to its own file, so the
+    download does not have to fit in memory. Returns the files written.
+    """
+    name = name or f"part-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.parquet"
+    lf = pl.scan_parquet(source)
+    written = []
+    for values in lf.select(by).unique().collect().iter_rows(named=True):
+        directory = os.path.join(root, *(
+            f"{key}={DEFAULT_PARTITION if value is None else quote(str(value), safe='')}"
+            for key, value in values.items()
+        ))
+        os.makedirs(directory, exist_ok=True)
+        predicate = pl.all_horizontal([
+            pl.col(key).is_null() if value is None else pl.col(key) == value for key, value in values.items()
+        ])
+        path = os.path.join(directory, name)
+        tmp_path = os.path.join(directory, f".{name}.tmp")
+        lf.filter(predicate).sink_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        written.append(path)
+    logger.info("Added %d part files from %s to %s", len(written), source, root)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage a hive-partitioned occurrence dataset.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add = subparsers.add_parser("add", help="Add a GBIF download to the dataset as new part files.")
+    add.add_argument("source", help="Parquet file to add.")
+    add.add_argument("root", help="Dataset directory.")
+    add.add_argument("--by", nargs="+", default=["country"], help="Partition columns (default: country).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    add_files(args.source, args.root, args.by)
+
+
+if __name__ == "__main__":
+    main()
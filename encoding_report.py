@@ -0,0 +1,57 @@
+"""Compare memory use and filter latency of plain-string vs dictionary-encoded label columns.
+
+    python encoding_report.py [--source PATH] [--repeat N]
+"""
+import argparse
+import statistics
+import time
+
+from data import CATEGORICAL_COLUMNS, DATA_PATH, load_data
+from filter_engine import FilterEngine, normalize_filters
+
+
+def _filter_states(data):
+    country = data["Country"].drop_nulls().cast(str).mode().to_list()[0]
+    species = data["Species"].drop_nulls().cast(str).mode().to_list()[0]
+    life_stage = data["LifeStage"].drop_nulls().cast(str).mode().to_list()[0]
+    return {
+        "country": normalize_filters([country], uncertainty=1000),
+        "country+life_stage": normalize_filters([country], life_stage, uncertainty=1000),
+        "species": normalize_filters(species=species, uncertainty=1000),
+        "all filters": normalize_filters([country], life_stage, "Male", species, 100),
+    }
+
+
+def _median_ms(engine, state, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        engine._filter(state)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source", default=DATA_PATH)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    plain = load_data("eager", args.source, encode=False)
+    encoded = load_data("eager", args.source, encode=True)
+
+    print(f"{'column':<12}{'string MB':>12}{'encoded MB':>12}")
+    for column in CATEGORICAL_COLUMNS:
+        print(f"{column:<12}{plain[column].estimated_size('mb'):>12.1f}{encoded[column].estimated_size('mb'):>12.1f}")
+    print(f"{'total':<12}{plain.estimated_size('mb'):>12.1f}{encoded.estimated_size('mb'):>12.1f}")
+    print()
+
+    plain_engine, encoded_engine = FilterEngine(plain), FilterEngine(encoded)
+    print(f"{'filter':<20}{'string ms':>12}{'encoded ms':>12}")
+    for name, state in _filter_states(plain).items():
+        print(f"{name:<20}{_median_ms(plain_engine, state, args.repeat):>12.2f}"
+              f"{_median_ms(encoded_engine, state, args.repeat):>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
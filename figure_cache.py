@@ -0,0 +1,75 @@
+"""Rendered figures shared by every app process.
+
+Most visitors look at the same few views: the default filters and the
+popular countries. Their map and bar chart figures are kept in a diskcache
+(SQLite) store under ``GBIF_FIGURE_CACHE_DIR`` that the gunicorn workers and
+their render workers all read and write, bounded to ``GBIF_FIGURE_CACHE_MB``
+with least-recently-used eviction.
+
+Keys are the figure kind and its normalized callback inputs, prefixed with a
+dataset version (source size and mtime, frame layout and ``FIGURE_VERSION``).
+Figures of an older dataset are never looked up again and age out of the
+store by eviction.
+"""
+import json
+import os
+
+import diskcache
+
+from data import FRAME_VERSION, source_stamp
+
+CACHE_DIR = os.environ.get("GBIF_FIGURE_CACHE_DIR", "./figure_cache")
+CACHE_MB = float(os.environ.get("GBIF_FIGURE_CACHE_MB", 256))
+# Bump when a change to the figure builders changes their output.
+FIGURE_VERSION = 2
+# How long one process may hold the prewarm claim before another retries it.
+CLAIM_SECONDS = 3600
+
+
+def dataset_version(source):
+    """Version string of the dataset at ``source`` and of the figures built from it."""
+    stamp = source_stamp(source)
+    return f"{FIGURE_VERSION}.{FRAME_VERSION}.{stamp['source_size']}.{stamp['source_mtime_ns']}"
+
+
+class FigureCache:
+    """Figures keyed by kind and inputs in a size-bounded LRU store on disk.
+
+    ``hits`` and ``misses`` count this process's lookups.
+    """
+
+    def __init__(self, source, directory=CACHE_DIR, size_mb=CACHE_MB):
+        self.version = dataset_version(source)
+        self.store = diskcache.Cache(directory, size_limit=int(size_mb * 1e6),
+                                     eviction_policy="least-recently-used")
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, kind, inputs):
+        return json.dumps([self.version, kind, *inputs])
+
+    def get(self, kind, *inputs):
+        """Cached figure of ``kind`` for ``inputs`` (JSON-serializable), or None."""
+        fig = self.store.get(self._key(kind, inputs))
+        if fig is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fig
+
+    def set(self, kind, *inputs, fig):
+        self.store.set(self._key(kind, inputs), fig)
+
+    def claim(self, name):
+        """True for the first process to claim ``name`` for this dataset version."""
+        return self.store.add(self._key("claim", [name]), os.getpid(), expire=CLAIM_SECONDS)
+
+    def volume_mb(self):
+        return self.store.volume() / 1e6
+
+
+def load_figure_cache(source, directory=CACHE_DIR, size_mb=CACHE_MB):
+    """The shared figure cache for ``source``, or None when ``GBIF_FIGURE_CACHE_MB`` is 0."""
+    if size_mb <= 0:
+        return None
+    return FigureCache(source, directory, size_mb)
@@ -0,0 +1,253 @@
+"""Shared filter engine for the dashboard callbacks.
+
+Every callback used to rebuild the same Country/LifeStage/Sex/Species/Uncertainty
+filter chain against the full dataset. The engine compiles the filter state
+into one Polars expression and keeps a bounded LRU cache of filtered frames, so
+the callbacks fired by a single interaction share a single scan.
+"""
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+import polars as pl
+
+from spatial import QUADKEY, quadkey_expr
+
+
+# Thresholds offered by the uncertainty dropdown; precomputed aggregates store
+# counts per disjoint bucket between them.
+UNCERTAINTY_BUCKETS = (1, 10, 50, 100, 500, 1000)
+
+
+class FilterState(NamedTuple):
+    """Normalized, hashable filter state used as the cache key."""
+    country: Tuple[str, ...] = ()
+    life_stage: Optional[str] = None
+    sex: Optional[str] = None
+    species: Optional[str] = None
+    uncertainty: Optional[int] = None
+    years: Optional[Tuple[int, int]] = None
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+def _normalize_choice(value):
+    """Map the dropdown sentinel values ("All", empty) to None."""
+    if value is None or value == "" or value == "All":
+        return None
+    return str(value)
+
+
+def normalize_filters(country=None, life_stage=None, sex=None, species=None, uncertainty=None, years=None):
+    """Turn raw callback inputs into a canonical FilterState.
+
+    ``years`` is an inclusive ``(first, last)`` year range; pass None rather
+    than the full range of the data so unfiltered states stay cacheable as such.
+    """
+    if isinstance(country, str):
+        country = [country]
+    countries = tuple(sorted(set(country or ())))
+    if "All" in countries:
+        countries = ()
+    return FilterState(
+        country=countries,
+        life_stage=_normalize_choice(life_stage),
+        sex=_normalize_choice(sex),
+        species=_normalize_choice(species),
+        uncertainty=int(uncertainty) if uncertainty not in (None, "") else None,
+        years=(int(min(years)), int(max(years))) if years else None,
+    )
+
+
+def enum_codes(schema):
+    """Label -> physical code mapping for every Enum column in ``schema``."""
+    return {
+        name: {label: code for code, label in enumerate(dtype.categories.to_list())}
+        for name, dtype in schema.items()
+        if isinstance(dtype, pl.Enum)
+    }
+
+
+def _label_predicate(column, labels, codes):
+    """Equality/membership test on a label column, on integer codes for Enum columns."""
+    if column not in codes:
+        return pl.col(column).is_in(labels) if len(labels) > 1 else pl.col(column) == labels[0]
+    wanted = [codes[column][label] for label in labels if label in codes[column]]
+    if not wanted:
+        return pl.lit(False)
+    physical = pl.col(column).to_physical()
+    return physical.is_in(wanted) if len(wanted) > 1 else physical == wanted[0]
+
+
+def build_filter_expr(state, codes=None):
+    """Compile a FilterState into a single Polars predicate, or None if unfiltered.
+
+    ``codes`` is the ``enum_codes`` mapping of the frame being filtered; labels
+    of Enum columns are resolved to their codes once, here, so the scan
+    compares integers instead of strings.
+    """
+    codes = codes or {}
+    predicates = []
+    if state.country:
+        predicates.append(_label_predicate("Country", list(state.country), codes))
+    if state.life_stage is not None:
+        predicates.append(_label_predicate("LifeStage", [state.life_stage], codes))
+    if state.sex is not None:
+        predicates.append(_label_predicate("Sex", [state.sex], codes))
+    if state.species is not None:
+        predicates.append(_label_predicate("Species", [state.species], codes))
+    if state.uncertainty is not None:
+        predicates.append(pl.col("Uncertainty") <= state.uncertainty)
+    if state.years is not None:
+        predicates.append(pl.col("Year").is_between(*state.years))
+    if not predicates:
+        return None
+    return pl.all_horizontal(predicates)
+
+
+def bucket_expr():
+    """Disjoint uncertainty bucket per row.
+
+    Bucket ``i`` holds values in ``(UNCERTAINTY_BUCKETS[i-1], UNCERTAINTY_BUCKETS[i]]``,
+    so ``Uncertainty <= UNCERTAINTY_BUCKETS[i]`` is exactly ``bucket <= i``.
+    Values above the last threshold and NaN land one past the end, nulls two.
+    """
+    above = pl.sum_horizontal([(pl.col("Uncertainty") > edge).cast(pl.Int8) for edge in UNCERTAINTY_BUCKETS])
+    return (
+        pl.when(pl.col("Uncertainty").is_null())
+        .then(pl.lit(len(UNCERTAINTY_BUCKETS) + 1, pl.Int8))
+        .otherwise(above)
+        .cast(pl.Int8)
+        .alias("bucket")
+    )
+
+
+def bucket_filter_supported(state):
+    """Whether ``state`` can be answered from tables that only keep the uncertainty bucket."""
+    return state.uncertainty is None or state.uncertainty in UNCERTAINTY_BUCKETS
+
+
+def build_bucket_filter_expr(state, codes=None):
+    """Like ``build_filter_expr`` but for tables with a ``bucket`` column instead of ``Uncertainty``."""
+    expr = build_filter_expr(state._replace(uncertainty=None), codes)
+    if state.uncertainty is None:
+        return expr
+    bucket = pl.col("bucket") <= UNCERTAINTY_BUCKETS.index(state.uncertainty)
+    return bucket if expr is None else expr & bucket
+
+
+class FilterEngine:
+    """Filters the dataset once per distinct FilterState and caches the result.
+
+    ``data`` may be an eager DataFrame or a LazyFrame over the parquet file.
+    In eager mode the whole filtered frame is cached and callbacks project
+    their columns from it. In lazy mode every query pushes both the predicate
+    and the column projection into the scan, so parquet row groups whose
+    statistics cannot match are skipped and only the requested columns are
+    read; the collected result is cached per (state, columns). Lazy frames
+    have no ``Quadkey`` column, so it is computed on the filtered rows.
+
+    An optional ``BitmapIndex`` over the eager frame resolves filter states to
+    row positions without scanning the columns. For a partitioned dataset in
+    lazy mode, ``scanner`` maps a state to a LazyFrame over only the files it
+    can match (None if there are none, see ``data.partition_scanner``).
+
+    Concurrent requests for the same key wait for the first one to finish
+    instead of scanning the data in parallel, which is what happens when Dash
+    fires several callbacks for one dropdown change.
+    """
+
+    def __init__(self, data, maxsize=16, index=None, scanner=None):
+        self.data = data
+        self.index = index
+        self.scanner = scanner
+        self.lazy = isinstance(data, pl.LazyFrame)
+        self.codes = enum_codes(data.collect_schema())
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def filtered(self, state, columns=None):
+        """Return the rows matching ``state``, optionally projected to ``columns``."""
+        columns = tuple(columns) if columns is not None else None
+        if self.lazy:
+            return self.cached(("rows", state, columns), lambda: self._scan(state, columns).collect())
+        df = self.cached(("rows", state, None), lambda: self._filter(state))
+        return df if columns is None else df.select(columns)
+
+    def count(self, state):
+        """Return the number of rows matching ``state``."""
+        if self.lazy:
+            return self.cached(("count", state), lambda: self._scan(state).select(pl.len()).collect().item())
+        return self.filtered(state).height
+
+    def _filter(self, state):
+        expr = build_filter_expr(state, self.codes)
+        if expr is None:
+            return self.data
+        if self.index is not None and not self.lazy:
+            rows = self.index.rows(state)
+            if rows is not None:
+                return self.data[rows]
+        data = self.data
+        if self.scanner is not None and self.lazy:
+            data = self.scanner(state)
+            if data is None:
+                return self.data.clear()
+        return data.filter(expr)
+
+    def _scan(self, state, columns=None):
+        lf = self._filter(state)
+        if columns is not None:
+            if QUADKEY in columns and QUADKEY not in lf.collect_schema().names():
+                # Computed after the filter, which Polars cannot push past the key's map_batches.
+                lf = lf.with_columns(quadkey_expr("decimalLatitude", "decimalLongitude"))
+            lf = lf.select(columns)
+        return lf
+
+    def cached(self, key, compute):
+        """Return the cached value for ``key``, computing it once with ``compute()`` on a miss."""
+        with self._lock:
+            if key in self._cache:
+                self._hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            key_lock = self._pending.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._cache:
+                    self._hits += 1
+                    self._cache.move_to_end(key)
+                    return self._cache[key]
+                self._misses += 1
+            try:
+                result = compute()
+                with self._lock:
+                    self._cache[key] = result
+                    while len(self._cache) > self.maxsize:
+                        self._cache.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+        return result
+
+    def cache_info(self):
+        """Return hit/miss counters and the current cache occupancy."""
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        """Drop all cached results and reset the counters."""
+        with self._lock:
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
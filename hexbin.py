@@ -0,0 +1,289 @@
+"""Vectorized hexagonal binning for the occurrence map.
+
+Replaces ``plotly.figure_factory.create_hexbin_mapbox`` on raw points. The
+hexagon lattice is the same one plotly uses (regular hexagons in Web Mercator
+space, ``nx_hexagon`` columns across the data extent), but points are assigned
+to cells with Polars expressions and only the non-empty hexagons are turned
+into GeoJSON, so the figure stays small regardless of the number of points.
+Large point sets are counted in row chunks on the aggregation thread pool
+(see ``parallel``) and the partial counts summed.
+"""
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+from plotly.colors import get_colorscale
+
+from parallel import map_chunks
+from payload import typed_array
+
+LAT = "decimalLatitude"
+LON = "decimalLongitude"
+# Hexagon vertices are rounded to about a metre, which halves the GeoJSON.
+COORDINATE_DECIMALS = 5
+
+# Unit hexagon outline, in units of (dx, dy / sqrt(3)).
+_HEX_X = np.array([0, 0.5, 0.5, 0, -0.5, -0.5])
+_HEX_Y = np.array([
+    -0.5 / np.cos(np.pi / 6),
+    -0.5 * np.tan(np.pi / 6),
+    0.5 * np.tan(np.pi / 6),
+    0.5 / np.cos(np.pi / 6),
+    0.5 * np.tan(np.pi / 6),
+    -0.5 * np.tan(np.pi / 6),
+])
+
+
+class HexGrid(NamedTuple):
+    """Hexagon lattice in projected coordinates.
+
+    Cells are numbered like plotly's two interleaved lattices: the first
+    ``(nx + 1) * (ny + 1)`` ids are the corner lattice, the remaining
+    ``nx * ny`` ids are the offset lattice.
+    """
+    xmin: float
+    ymin: float
+    dx: float
+    dy: float
+    nx: int
+    ny: int
+
+    @property
+    def n_cells(self):
+        return (self.nx + 1) * (self.ny + 1) + self.nx * self.ny
+
+
+def project(lat, lon):
+    """Project lat/lon degrees to Web Mercator radians."""
+    return np.radians(lon), np.arctanh(np.sin(np.radians(lat)))
+
+
+def unproject(x, y):
+    """Inverse of ``project``."""
+    return np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2), np.degrees(x)
+
+
+def make_grid(lat_range, lon_range, nx):
+    """Build the lattice covering ``lat_range`` x ``lon_range`` with ``nx`` columns."""
+    xmin, xmax = np.radians(lon_range[0]), np.radians(lon_range[1])
+    _, ymin = project(lat_range[0], 0.0)
+    _, ymax = project(lat_range[1], 0.0)
+
+    padding = 1.0e-9 * (xmax - xmin)
+    xmin -= padding
+    xmax += padding
+
+    width = xmax - xmin
+    height = ymax - ymin
+    if width == 0 and height > 0:
+        dx = height / nx
+    elif width == 0 and height == 0:
+        dx = np.radians(1.0)
+    else:
+        dx = width / nx
+    dy = dx * np.sqrt(3)
+    ny = int(np.ceil(height / dy))
+
+    # Center the hexagons vertically since we only want regular hexagons
+    ymin -= (ymin + dy * ny - ymax) / 2
+    return HexGrid(float(xmin), float(ymin), float(dx), float(dy), int(nx), ny)
+
+
+def cell_expr(grid, lat=LAT, lon=LON):
+    """Polars expression mapping each point to its hexagon id (null if outside the grid)."""
+    return projected_cell_expr(grid, pl.col(lon).radians(), pl.col(lat).radians().sin().arctanh())
+
+
+def projected_cell_expr(grid, x, y):
+    """Like ``cell_expr`` for expressions ``x`` and ``y`` already in projected coordinates."""
+    x = (x - grid.xmin) / grid.dx
+    y = (y - grid.ymin) / grid.dy
+    ix1, iy1 = x.round(), y.round()
+    ix2, iy2 = x.floor(), y.floor()
+    d1 = (x - ix1) ** 2 + 3.0 * (y - iy1) ** 2
+    d2 = (x - ix2 - 0.5) ** 2 + 3.0 * (y - iy2 - 0.5) ** 2
+
+    nx1, ny1 = grid.nx + 1, grid.ny + 1
+    in_first = (ix1 >= 0) & (ix1 < nx1) & (iy1 >= 0) & (iy1 < ny1)
+    in_second = (ix2 >= 0) & (ix2 < grid.nx) & (iy2 >= 0) & (iy2 < grid.ny)
+    return (
+        pl.when((d1 < d2) & in_first).then(ix1 * ny1 + iy1)
+        .when((d1 >= d2) & in_second).then(nx1 * ny1 + ix2 * grid.ny + iy2)
+        .otherwise(None)
+        .cast(pl.Int64)
+        .alias("cell")
+    )
+
+
+def hexbin_counts(df, grid, lat=LAT, lon=LON):
+    """Count points per non-empty hexagon; returns (cell ids, counts) sorted by id."""
+    parts = map_chunks(lambda chunk: _point_cell_counts(chunk, grid, lat, lon), df)
+    # A hexagon straddling two chunks has a partial count in each.
+    counts = (
+        pl.concat(parts)
+        .lazy()
+        .group_by("cell")
+        .agg(pl.col("count").sum())
+        .sort("cell")
+        .collect()
+    )
+    return counts["cell"].to_numpy(), counts["count"].to_numpy()
+
+
+def _point_cell_counts(df, grid, lat, lon):
+    return (
+        df.lazy()
+        .select(cell_expr(grid, lat, lon))
+        .drop_nulls()
+        .group_by("cell")
+        .agg(pl.len().cast(pl.Int64).alias("count"))
+        .collect()
+    )
+
+
+def cell_centers(grid, cells):
+    """Projected (x, y) centers of the given hexagon ids."""
+    cells = np.asarray(cells)
+    nx1, ny1 = grid.nx + 1, grid.ny + 1
+    first = cells < nx1 * ny1
+    offset = np.where(first, 0, cells - nx1 * ny1)
+    cx = np.where(first, cells // ny1, offset // max(grid.ny, 1) + 0.5)
+    cy = np.where(first, cells % ny1, offset % max(grid.ny, 1) + 0.5)
+    return grid.xmin + cx * grid.dx, grid.ymin + cy * grid.dy
+
+
+def hexagon_geojson(grid, cells):
+    """GeoJSON FeatureCollection with one polygon per hexagon id."""
+    cx, cy = cell_centers(grid, cells)
+    xs = cx[:, None] + _HEX_X * grid.dx
+    ys = cy[:, None] + _HEX_Y * grid.dy / np.sqrt(3)
+    lats, lons = unproject(xs, ys)
+    rings = np.stack([lons, lats], axis=-1).round(COORDINATE_DECIMALS)
+    rings = np.concatenate([rings, rings[:, :1]], axis=1).tolist()
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "id": int(cell), "geometry": {"type": "Polygon", "coordinates": [ring]}}
+            for cell, ring in zip(cells, rings)
+        ],
+    }
+
+
+def bounds_zoom(lat_range, lon_range, width=450, height=450):
+    """Mapbox zoom level that fits the bounds into a map of the given size."""
+    world = 512
+
+    def lat_rad(lat):
+        sin = np.sin(np.radians(lat))
+        return max(min(np.log((1 + sin) / (1 - sin)) / 2, np.pi), -np.pi) / 2
+
+    def zoom(map_px, fraction):
+        return 0.95 * np.log(map_px / world / fraction) / np.log(2)
+
+    lat_fraction = (lat_rad(lat_range[1]) - lat_rad(lat_range[0])) / np.pi
+    lon_diff = lon_range[1] - lon_range[0]
+    lon_fraction = ((lon_diff + 360) if lon_diff < 0 else lon_diff) / 360
+    with np.errstate(divide="ignore"):
+        return float(min(zoom(height, lat_fraction), zoom(width, lon_fraction), 18))
+
+
+class HexbinResult(NamedTuple):
+    """Non-empty hexagons of a grid plus the data extent used to frame the map.
+
+    ``fraction`` is the share of the points that was binned when the counts
+    are estimated from a sample.
+    """
+    grid: HexGrid
+    cells: np.ndarray
+    counts: np.ndarray
+    lat_range: tuple
+    lon_range: tuple
+    fraction: float = 1.0
+
+
+def data_extent(df, lat=LAT, lon=LON):
+    """``(lat_range, lon_range)`` of the points in ``df``, or None if it has none."""
+    extent = df.lazy().select(
+        pl.col(lat).min().alias("lat_min"), pl.col(lat).max().alias("lat_max"),
+        pl.col(lon).min().alias("lon_min"), pl.col(lon).max().alias("lon_max"),
+    ).collect().row(0)
+    if extent[0] is None:
+        return None
+    return extent[:2], extent[2:]
+
+
+def compute_hexbin(df, nx_hexagon, extent=None, lat=LAT, lon=LON, fraction=1.0):
+    """Bin the points in ``df`` on a grid with ``nx_hexagon`` columns.
+
+    The grid spans ``extent`` (a ``(lat_range, lon_range)`` pair, e.g. the
+    visible map area) or, by default, the extent of the points themselves.
+    When ``df`` is a sample holding ``fraction`` of the points, the counts are
+    scaled up accordingly. Returns None if there is nothing to bin.
+    """
+    extent = extent or data_extent(df, lat, lon)
+    if extent is None:
+        return None
+    lat_range, lon_range = extent
+    grid = make_grid(lat_range, lon_range, int(nx_hexagon))
+    cells, counts = hexbin_counts(df, grid, lat, lon)
+    if fraction < 1:
+        counts = np.rint(counts / fraction).astype(np.int64)
+    return HexbinResult(grid, cells, counts, lat_range, lon_range, fraction)
+
+
+def hexbin_figure(bins, opacity=0.4, color_continuous_scale="turbo", label="Point Count", mapbox_token=None,
+                  uirevision=None, geometry=None):
+    """Build a choropleth containing only the non-empty hexagons of ``bins``.
+
+    The figure is returned as a plain dict with the hexagon ids and counts as
+    typed arrays, skipping plotly's validation. ``geometry`` is the URL of a
+    GeoJSON holding (at least) these hexagons of ``bins.grid``; without it the
+    polygons are inlined. ``uirevision`` is passed to the layout so the user's
+    pan/zoom survives updates for as long as it stays the same.
+    """
+    if bins is None or not len(bins.cells):
+        cells, counts, geometry = np.array([], dtype=np.int64), np.array([], dtype=np.int64), None
+        center, zoom = {"lat": 0.0, "lon": 0.0}, 0
+    else:
+        cells, counts = bins.cells, bins.counts
+        geometry = geometry or hexagon_geojson(bins.grid, cells)
+        center = {"lat": sum(bins.lat_range) / 2, "lon": sum(bins.lon_range) / 2}
+        zoom = bounds_zoom(bins.lat_range, bins.lon_range)
+
+    fraction = bins.fraction if bins is not None else 1.0
+    annotations = []
+    if fraction < 1:
+        label = f"{label} (approx.)"
+        annotations.append({
+            "text": f"Approximate: {fraction:.1%} sample",
+            "xref": "paper", "yref": "paper", "x": 0.01, "y": 0.99, "xanchor": "left", "yanchor": "top",
+            "showarrow": False, "bgcolor": "#fff3bf", "bordercolor": "#f08c00", "borderwidth": 1,
+            "borderpad": 4, "font": {"size": 12, "color": "#7a4a00"},
+        })
+
+    trace = {
+        "type": "choroplethmapbox",
+        "geojson": geometry,
+        "locations": typed_array(cells),
+        "z": typed_array(counts),
+        "coloraxis": "coloraxis",
+        "marker": {"opacity": opacity},
+        "hovertemplate": f"{label}=%{{z}}<extra></extra>",
+        "name": "",
+    }
+    layout = {
+        "mapbox": {"center": center, "zoom": zoom, "accesstoken": mapbox_token, "style": "light"},
+        "coloraxis": {
+            "colorscale": get_colorscale(color_continuous_scale),
+            "colorbar": {"title": {"text": label}, "outlinewidth": 0, "ticks": ""},
+            "cmin": int(counts.min()) if len(counts) else None,
+            "cmax": int(counts.max()) if len(counts) else None,
+        },
+        "font": {"color": "#2a3f5f"},
+        "legend": {"tracegroupgap": 0},
+        "margin": {"t": 60},
+        "annotations": annotations,
+        "meta": {"sample_fraction": fraction},
+        "uirevision": uirevision,
+    }
+    return {"data": [trace], "layout": layout}
@@ -0,0 +1,242 @@
+"""Convert a GBIF Darwin Core Archive into the parquet the app reads.
+
+    python ingest.py 0012345-240101123456789.zip data/dragonfly_database.parquet
+
+The archive's ``occurrence.txt`` (or a path to the extracted file) is read
+with Polars' streaming engine, so memory stays bounded whatever its size.
+Ingestion runs in two passes:
+
+1. stream the tab-separated file into a staging parquet, keeping only
+   ``data.SOURCE_COLUMNS`` and the date columns (``data.TEMPORAL_COLUMNS``),
+   trimming strings, turning empty and "unknown"-like labels into nulls,
+   title-casing the life stage and sex vocabularies and casting to compact
+   dtypes;
+2. sort the staged rows by Country, Species and then spatial key (the
+   ``Quadkey`` of ``spatial``) and write them in small row groups. Row groups
+   then cover narrow Country and Species ranges, so their min/max statistics
+   let filtered scans skip most of the file. The (Country, Species) groups
+   are packed, in key order, into parts of at most ``--sort-rows`` rows; a
+   group larger than that is split between its Quadkey tiles at
+   ``SPLIT_ZOOM``. One streaming pass writes every part to its own file, and
+   each part is then sorted in memory on its own and appended to the output.
+
+Both passes log their throughput in rows per second.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import polars as pl
+
+from data import SOURCE_COLUMNS, TEMPORAL_COLUMNS
+from spatial import BASE_ZOOM, quadkey_expr
+
+logger = logging.getLogger(__name__)
+
+ROW_GROUP_ROWS = 128 * 1024
+SORT_BATCH_ROWS = 5_000_000
+SORT_COLUMNS = ["country", "species", quadkey_expr("decimalLatitude", "decimalLongitude")]
+# Groups too large to sort at once are split between their tiles at this zoom
+# (about 2.4 km); a split part can still exceed --sort-rows if one tile does.
+SPLIT_ZOOM = 14
+DTYPES = {
+    "gbifID": pl.Int64,
+    "decimalLatitude": pl.Float64,
+    "decimalLongitude": pl.Float64,
+    "coordinateUncertaintyInMeters": pl.Float32,
+    "year": pl.Int16,
+    "month": pl.Int8,
+}
+# Labels that mean "not recorded"; the app shows missing values as "Unknown".
+MISSING_LABELS = ["", "unknown", "undetermined", "indeterminate", "not recorded", "na", "n/a", "none", "null"]
+VOCABULARY_COLUMNS = ["lifeStage", "sex"]
+
+
+def occurrence_file(source, workdir):
+    """Path of ``occurrence.txt``, extracting it from ``source`` if that is the zipped archive."""
+    if not zipfile.is_zipfile(source):
+        return source
+    path = os.path.join(workdir, "occurrence.txt")
+    with zipfile.ZipFile(source) as archive, archive.open("occurrence.txt") as src, open(path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    return path
+
+
+def normalize(lf):
+    """Project ``lf`` to the source and date columns with normalized nulls and compact dtypes."""
+    header = lf.collect_schema().names()
+    columns = SOURCE_COLUMNS + [column for column in TEMPORAL_COLUMNS if column in header]
+    missing = [column for column in SOURCE_COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"occurrence.txt has no {', '.join(missing)} column(s).")
+
+    def label(column):
+        value = pl.col(column).str.strip_chars()
+        value = pl.when(value.str.to_lowercase().is_in(MISSING_LABELS)).then(None).otherwise(value)
+        if column in VOCABULARY_COLUMNS:
+            value = value.str.replace_all("_", " ").str.to_titlecase()
+        return value.alias(column)
+
+    return lf.select([
+        pl.col(column).str.strip_chars().cast(DTYPES[column], strict=False) if column in DTYPES else label(column)
+        for column in columns
+    ])
+
+
+def stage(source, staging_path):
+    """Pass 1: stream ``source`` into a normalized staging parquet; returns the row count."""
+    lf = pl.scan_csv(source, separator="\t", quote_char=None, infer_schema=False,
+                     truncate_ragged_lines=True, encoding="utf8-lossy")
+    start = time.perf_counter()
+    normalize(lf).sink_parquet(staging_path, compression="lz4", engine="streaming")
+    rows = pl.scan_parquet(staging_path).select(pl.len()).collect().item()
+    elapsed = time.perf_counter() - start
+    logger.info("Staged %d rows (%.0f MB of text) in %.1fs, %.0f rows/s",
+                rows, os.path.getsize(source) / 1e6, elapsed, rows / max(elapsed, 1e-9))
+    return rows
+
+
+def sort_batches(counts, max_rows):
+    """Pack consecutive units of a frame whose last column is their row count into batches of at most ``max_rows``.
+
+    Each batch is a list of the units' other columns as tuples; a unit larger
+    than ``max_rows`` gets a batch of its own.
+    """
+    batches, batch, size = [], [], 0
+    for *unit, n in counts.iter_rows():
+        if batch and size + n > max_rows:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(tuple(unit))
+        size += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _group_key():
+    # Empty labels were turned into nulls while staging, so "" can stand for null.
+    return pl.concat_str([pl.col("country").fill_null(""), pl.col("species").fill_null("")], separator="\t")
+
+
+def _tile_expr():
+    return (SORT_COLUMNS[-1] // (1 << 2 * (BASE_ZOOM - SPLIT_ZOOM))).alias("_tile")
+
+
+def sort_units(staged, max_rows):
+    """Units of the staged rows in output order, with their row counts.
+
+    A unit is a (Country, Species) group, as ``_group`` with a null ``_tile``,
+    or for groups over ``max_rows`` rows one ``_tile`` of the group.
+    """
+    counts = (
+        staged.group_by(["country", "species"]).len()
+        .sort(["country", "species"], nulls_last=True)
+        .select(_group_key().alias("_group"), pl.lit(None, pl.UInt64).alias("_tile"), "len")
+        .collect(engine="streaming")
+    )
+    large = counts.filter(pl.col("len") > max_rows)["_group"]
+    if large.is_empty():
+        return counts, large
+    tiles = (
+        staged.filter(_group_key().is_in(large.implode()))
+        .group_by(_group_key().alias("_group"), _tile_expr()).len()
+        .collect(engine="streaming")
+    )
+    order = pl.int_range(pl.len()).alias("_order")
+    units = (
+        pl.concat([counts.filter(pl.col("len") <= max_rows), tiles])
+        .join(counts.select("_group", order), on="_group")
+        .sort(["_order", "_tile"], nulls_last=True)
+        .drop("_order")
+    )
+    return units, large
+
+
+def write_parts(staged, units, large, parts_dir, max_rows):
+    """Write the staged rows to one part per batch of ``units`` in one streaming pass; returns the part count."""
+    batches = sort_batches(units, max_rows)
+    parts = pl.DataFrame(
+        [(group, tile, part) for part, batch in enumerate(batches) for group, tile in batch],
+        schema={"_group": pl.String, "_tile": pl.UInt64, "_part": pl.UInt32},
+        orient="row",
+    )
+    group = _group_key()
+    (
+        staged.with_columns(group.alias("_group"), pl.when(group.is_in(large.implode())).then(_tile_expr()))
+        .join(parts.lazy(), on=["_group", "_tile"], how="left", nulls_equal=True)
+        .drop("_group", "_tile")
+        .sink_parquet(pl.PartitionBy(parts_dir, key="_part", include_key=False), compression="lz4",
+                      engine="streaming", mkdir=True)
+    )
+    return len(batches)
+
+
+def write_sorted(staging_path, output, max_rows=SORT_BATCH_ROWS, row_group_rows=ROW_GROUP_ROWS):
+    """Pass 2: write the staged rows to ``output`` sorted by ``SORT_COLUMNS``; returns the row count."""
+    import pyarrow.parquet as pq
+
+    staged = pl.scan_parquet(staging_path)
+    start = time.perf_counter()
+    parts_dir = f"{staging_path}.parts"
+    units, large = sort_units(staged, max_rows)
+    n_parts = write_parts(staged, units, large, parts_dir, max_rows)
+    logger.info("Split the staged rows into %d parts (%d groups split by tile) in %.1fs",
+                n_parts, len(large), time.perf_counter() - start)
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    writer, rows = None, 0
+    try:
+        for part in range(n_parts):
+            files = os.path.join(parts_dir, f"_part={part}", "*.parquet")
+            batch = pl.scan_parquet(files).sort(SORT_COLUMNS, nulls_last=True).collect()
+            table = batch.to_arrow()
+            writer = writer or pq.ParquetWriter(tmp_path, table.schema, compression="zstd")
+            writer.write_table(table, row_group_size=row_group_rows)
+            rows += batch.height
+    finally:
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    os.replace(tmp_path, output)
+    elapsed = time.perf_counter() - start
+    logger.info("Wrote %d sorted rows to %s (%.0f MB) in %.1fs, %.0f rows/s",
+                rows, output, os.path.getsize(output) / 1e6, elapsed, rows / max(elapsed, 1e-9))
+    return rows
+
+
+def ingest(source, output, max_rows=SORT_BATCH_ROWS, row_group_rows=ROW_GROUP_ROWS, workdir=None):
+    """Convert the DwC-A (or its ``occurrence.txt``) at ``source`` to the app's parquet at ``output``."""
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=workdir or os.path.dirname(output) or ".") as tmp:
+        text = occurrence_file(source, tmp)
+        staging_path = os.path.join(tmp, "staging.parquet")
+        stage(text, staging_path)
+        rows = write_sorted(staging_path, output, max_rows, row_group_rows)
+    elapsed = time.perf_counter() - start
+    logger.info("Ingested %d rows in %.1fs, %.0f rows/s overall", rows, elapsed, rows / max(elapsed, 1e-9))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a GBIF Darwin Core Archive to the app's parquet.")
+    parser.add_argument("source", help="GBIF DwC-A zip, or its extracted occurrence.txt.")
+    parser.add_argument("output", help="Parquet file to write.")
+    parser.add_argument("--sort-rows", type=int, default=SORT_BATCH_ROWS,
+                        help="Rows sorted in memory at a time (default: %(default)s).")
+    parser.add_argument("--row-group-rows", type=int, default=ROW_GROUP_ROWS,
+                        help="Rows per parquet row group (default: %(default)s).")
+    parser.add_argument("--workdir", default=None,
+                        help="Where the extracted text and staging file go (default: next to the output).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ingest(args.source, args.output, args.sort_rows, args.row_group_rows, args.workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Callback timings, Prometheus metrics and an opt-in sampling profiler.
+
+Callback builders are wrapped with ``timed``; inside them ``stage("filter")``
+blocks and ``rows(n)`` calls attribute time and matched rows to stages. Dash
+serialization is timed per callback output between the end of the callback
+and the response, and ``payload`` supplies the response sizes. ``instrument``
+exposes it all on ``/metrics`` in the Prometheus text format.
+
+Work done in the map render workers is recorded in those processes: wrap it
+in ``capture()`` and hand the captured records to ``replay`` in the app
+process.
+
+Setting ``GBIF_PROFILE_SLOW_MS`` samples the Python stack of every callback
+request and writes the samples of requests slower than that as folded stacks
+(``frame;frame;frame count``, the input format of flamegraph.pl and
+speedscope) to ``GBIF_PROFILE_DIR``.
+"""
+import contextvars
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+
+from payload import callback_output, payload_stats
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_SLOW_MS = float(os.environ.get("GBIF_PROFILE_SLOW_MS", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("GBIF_PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("GBIF_PROFILE_DIR", "./profiles")
+
+_record = contextvars.ContextVar("metrics_record", default=None)
+_capture = contextvars.ContextVar("metrics_capture", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+class Registry:
+    """Per-process store of callback durations, stage timings and row counts."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.stages = {}
+        self.rows = {}
+        self.serialize = {}
+
+    def observe_call(self, record):
+        with self.lock:
+            callback = record["callback"]
+            self.durations.setdefault(callback, Histogram()).observe(record["seconds"])
+            for stage, seconds in record["stages"].items():
+                self.stages.setdefault((callback, stage), Histogram()).observe(seconds)
+            if record["rows"] is not None:
+                total = self.rows.setdefault(callback, [0, 0])
+                total[0] += record["rows"]
+                total[1] += 1
+
+    def observe_serialize(self, output, seconds):
+        with self.lock:
+            self.serialize.setdefault(output, Histogram()).observe(seconds)
+
+    def render(self, gauges=None):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} histogram"])
+            for labels, hist in series:
+                for bound, count in zip(BUCKETS, hist.counts):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+                lines.append(f"{name}_sum{{{labels}}} {hist.sum:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {hist.count}")
+
+        def summary(name, help_text, series):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} summary"])
+            for labels, (total, count) in series:
+                lines.append(f"{name}_sum{{{labels}}} {total}")
+                lines.append(f"{name}_count{{{labels}}} {count}")
+
+        with self.lock:
+            histogram("gbif_callback_duration_seconds", "Time spent in a callback builder.",
+                      [(_labels(callback=c), h) for c, h in sorted(self.durations.items())])
+            histogram("gbif_callback_stage_seconds", "Time spent in one stage of a callback builder.",
+                      [(_labels(callback=c, stage=s), h) for (c, s), h in sorted(self.stages.items())])
+            summary("gbif_callback_rows", "Occurrences matched by the filters of a callback.",
+                    [(_labels(callback=c), tuple(v)) for c, v in sorted(self.rows.items())])
+            histogram("gbif_callback_serialize_seconds", "Time from callback return to the response being ready.",
+                      [(_labels(output=o), h) for o, h in sorted(self.serialize.items())])
+
+        payloads = payload_stats.snapshot()
+        summary("gbif_callback_payload_bytes", "Response body size per callback output before compression.",
+                [(_labels(output=o), (e["raw_bytes"], e["responses"])) for o, e in sorted(payloads.items())])
+        summary("gbif_callback_payload_sent_bytes", "Response body size per callback output as sent.",
+                [(_labels(output=o), (e["sent_bytes"], e["responses"])) for o, e in sorted(payloads.items())])
+
+        for name, (help_text, value) in (gauges or {}).items():
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def _emit(record):
+    captured = _capture.get()
+    if captured is not None:
+        captured.append(record)
+    else:
+        registry.observe_call(record)
+
+
+def timed(fn):
+    """Record the duration, stages and rows of every call to ``fn`` under its name."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        record = {"callback": fn.__name__, "seconds": 0.0, "stages": {}, "rows": None}
+        token = _record.set(record)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            _record.reset(token)
+            _emit(record)
+            if flask.has_request_context():
+                flask.g.callback_done = time.perf_counter()
+
+    return wrapper
+
+
+@contextmanager
+def stage(name):
+    """Attribute the time spent in the block to stage ``name`` of the current callback."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = _record.get()
+        if record is not None:
+            record["stages"][name] = record["stages"].get(name, 0.0) + time.perf_counter() - start
+
+
+def rows(count):
+    """Set the number of occurrences the current callback matched."""
+    record = _record.get()
+    if record is not None:
+        record["rows"] = int(count)
+
+
+@contextmanager
+def capture():
+    """Collect the records of callbacks run in the block instead of recording them."""
+    records = []
+    token = _capture.set(records)
+    try:
+        yield records
+    finally:
+        _capture.reset(token)
+
+
+def replay(records):
+    """Record callbacks captured in another process."""
+    for record in records:
+        registry.observe_call(record)
+    if flask.has_request_context():
+        flask.g.callback_done = time.perf_counter()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                key = ";".join(reversed(names))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+def _write_profile(sampler, output, elapsed_ms):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{output.replace('.', '_')[:80]}-{elapsed_ms:.0f}ms.folded"
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path, "w") as f:
+        f.write(sampler.folded())
+    logger.info("Slow callback %s took %.0f ms, stacks written to %s", output, elapsed_ms, path)
+
+
+def instrument(server, gauges=None):
+    """Time callback serialization, serve ``/metrics`` and enable the slow-request profiler if configured.
+
+    ``gauges`` is called on every scrape and returns ``{name: (help, value)}``.
+    """
+
+    def is_callback():
+        return flask.request.path.endswith("/_dash-update-component")
+
+    @server.before_request
+    def start_timing():
+        if is_callback():
+            flask.g.request_started = time.perf_counter()
+            if PROFILE_SLOW_MS > 0:
+                flask.g.sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000).start()
+
+    @server.after_request
+    def stop_timing(response):
+        if not is_callback() or "request_started" not in flask.g:
+            return response
+        now = time.perf_counter()
+        output = callback_output(flask.request.get_json(silent=True) or {})
+        if "callback_done" in flask.g:
+            registry.observe_serialize(output, now - flask.g.callback_done)
+        sampler = flask.g.pop("sampler", None)
+        if sampler is not None:
+            sampler.stop()
+            elapsed_ms = (now - flask.g.request_started) * 1000
+            if elapsed_ms >= PROFILE_SLOW_MS:
+                _write_profile(sampler, output, elapsed_ms)
+        return response
+
+    @server.route("/metrics")
+    def metrics():
+        return flask.Response(registry.render(gauges() if gauges else None),
+                              mimetype="text/plain; version=0.0.4")
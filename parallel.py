@@ -0,0 +1,54 @@
+"""Thread pool splitting aggregations over row chunks.
+
+Polars runs group-bys and unique() on its own thread pool (sized by
+``POLARS_MAX_THREADS``), but an elementwise expression over one contiguous
+column, like assigning points to hexagons, and the numpy steps of the tile
+binning run on a single core. ``map_chunks`` splits such work into row chunks
+and runs them on a pool of ``GBIF_AGG_THREADS`` threads; numpy and Polars
+release the GIL while they compute, so the chunks use separate cores, and the
+caller merges the partial counts.
+
+The pool is shared by every request thread of the process and so also caps
+how many cores one process's aggregations take. With several gunicorn
+workers (and map render workers) per host, size it to about the number of
+cores divided by the number of processes.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+AGG_THREADS = int(os.environ.get("GBIF_AGG_THREADS", os.cpu_count() or 1))
+# Smaller chunks cost more to schedule and merge than they save.
+MIN_CHUNK_ROWS = 250_000
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(AGG_THREADS, thread_name_prefix="aggregate")
+    return _executor
+
+
+def chunk_bounds(n_rows, threads=AGG_THREADS, min_rows=MIN_CHUNK_ROWS):
+    """``(start, stop)`` ranges splitting ``n_rows`` into at most ``threads`` chunks of at least ``min_rows``."""
+    chunks = max(1, min(threads, n_rows // max(min_rows, 1)))
+    edges = np.linspace(0, n_rows, chunks + 1).astype(int).tolist()
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def map_chunks(fn, rows, threads=AGG_THREADS, min_rows=MIN_CHUNK_ROWS):
+    """Results of ``fn`` on consecutive row chunks of ``rows`` (an array or a frame), in order.
+
+    Several chunks run on the pool; ``fn`` must not call ``map_chunks``
+    itself, or it could wait on a pool it is occupying.
+    """
+    bounds = chunk_bounds(len(rows), threads, min_rows)
+    if len(bounds) == 1:
+        return [fn(rows)]
+    return list(_pool().map(lambda bound: fn(rows[bound[0]:bound[1]]), bounds))
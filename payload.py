@@ -0,0 +1,105 @@
+"""Compact figure payloads and per-callback payload sizes.
+
+Numeric trace arrays are sent as plotly.js typed arrays (``{"dtype", "bdata"}``
+with base64 little-endian bytes) instead of JSON number lists, using the
+narrowest integer type that holds the values. ``instrument`` records how many
+bytes each callback's responses take before and after compression.
+"""
+import base64
+import logging
+import threading
+
+import flask
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INTEGER_DTYPES = ["u1", "i1", "u2", "i2", "u4", "i4"]
+
+
+def typed_array(values):
+    """plotly.js typed-array spec for a numeric array; other arrays are returned as lists."""
+    values = np.asarray(values)
+    if not len(values) or values.dtype.kind not in "iufb":
+        return values.tolist()
+    dtype = "f8"
+    if values.dtype.kind in "iub":
+        low, high = values.min(), values.max()
+        dtype = next((d for d in INTEGER_DTYPES if np.iinfo(d).min <= low and high <= np.iinfo(d).max), "f8")
+    data = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {"dtype": dtype, "bdata": base64.b64encode(data.tobytes()).decode("ascii")}
+
+
+def _encode_arrays(node):
+    if isinstance(node, np.ndarray):
+        return typed_array(node)
+    if isinstance(node, dict):
+        return {key: _encode_arrays(value) for key, value in node.items()}
+    if isinstance(node, (list, tuple)):
+        return [_encode_arrays(value) for value in node]
+    return node
+
+
+def compact_figure(fig):
+    """Figure dict with every numeric array of its traces sent as a typed array."""
+    fig = fig.to_dict() if hasattr(fig, "to_dict") else fig
+    return {**fig, "data": [_encode_arrays(trace) for trace in fig["data"]]}
+
+
+class PayloadStats:
+    """Response count and raw/sent bytes per callback output."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outputs = {}
+
+    def record(self, output, raw_bytes, sent_bytes):
+        with self.lock:
+            entry = self.outputs.setdefault(output, {"responses": 0, "raw_bytes": 0, "sent_bytes": 0})
+            entry["responses"] += 1
+            entry["raw_bytes"] += raw_bytes
+            entry["sent_bytes"] += sent_bytes
+
+    def snapshot(self):
+        with self.lock:
+            return {output: dict(entry) for output, entry in self.outputs.items()}
+
+
+payload_stats = PayloadStats()
+
+
+def callback_output(body):
+    """Readable name of the outputs a callback request is for."""
+    outputs = body.get("outputs")
+    if isinstance(outputs, dict):
+        outputs = [outputs]
+    if not outputs:
+        return body.get("output", "unknown")
+    return ",".join(f"{output['id']}.{output['property']}" for output in outputs)
+
+
+def instrument(server, stats=payload_stats):
+    """Log and record the size of every callback response, before and after compression.
+
+    Must be called after Dash has set up compression on ``server``: Flask runs
+    the later-registered hook first, so the raw size is taken before the body
+    is compressed, and the sent size once the response is final.
+    """
+
+    @server.after_request
+    def measure_raw(response):
+        if flask.request.path.endswith("/_dash-update-component") and not response.direct_passthrough:
+            flask.g.payload_raw_bytes = response.content_length or 0
+        return response
+
+    def measure_sent(sender, response, **extra):
+        raw_bytes = flask.g.pop("payload_raw_bytes", None)
+        if raw_bytes is None:
+            return
+        body = flask.request.get_json(silent=True) or {}
+        output = callback_output(body)
+        sent_bytes = response.content_length or raw_bytes
+        stats.record(output, raw_bytes, sent_bytes)
+        logger.info("%s: %.1f kB, %.1f kB sent", output, raw_bytes / 1e3, sent_bytes / 1e3)
+
+    flask.request_finished.connect(measure_sent, server, weak=False)
@@ -0,0 +1,230 @@
+"""Precomputed multi-resolution hexbin pyramid for the occurrence map.
+
+The pyramid stores hexagon counts for every combination of the low-cardinality
+filter dimensions (Country, LifeStage, Sex and the uncertainty buckets) at a
+ladder of resolutions. All levels share one lattice anchored to the extent of
+the full dataset, so any filter state that only touches those dimensions is
+answered by summing a handful of precomputed rows instead of rebinning raw
+points. Species filters, year ranges and uncertainty thresholds that are not
+one of the dropdown buckets fall back to the raw path.
+
+Build the sidecar next to the parquet with::
+
+    python pyramid.py
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import polars as pl
+
+from data import DATA_PATH, load_data, source_stamp
+from filter_engine import bucket_expr, bucket_filter_supported, build_bucket_filter_expr, enum_codes
+from hexbin import (
+    LAT, LON, HexbinResult, cell_centers, cell_expr, hexagon_geojson, make_grid, project, unproject,
+)
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ["Country", "LifeStage", "Sex"]
+# Consecutive levels differ by at most 1.5x, so every hexagon size between the
+# coarsest and finest level is within MAX_SCALE_ERROR of a precomputed one.
+DEFAULT_LEVELS = (50, 75, 100, 150, 200, 300, 400, 600, 800, 1200, 1600)
+MAX_SCALE_ERROR = 1.25
+METADATA_KEY = "gbif_viewer.hexbins"
+# Levels with more non-empty hexagons than this inline the polygons of each
+# view rather than sharing one GeoJSON of the whole level.
+SHARED_GEOMETRY_MAX_CELLS = 20_000
+
+
+def pyramid_path(source=DATA_PATH):
+    """Location of the pyramid sidecar for ``source``."""
+    root, _ = os.path.splitext(source)
+    return root + ".hexbins.parquet"
+
+
+def build_pyramid(data, levels=DEFAULT_LEVELS):
+    """Aggregate hexagon counts per filter combination at every level.
+
+    Returns the count table and the (lat_range, lon_range) extent that anchors
+    the lattice.
+    """
+    extent = data.lazy().select(
+        pl.col(LAT).min().alias("lat_min"), pl.col(LAT).max().alias("lat_max"),
+        pl.col(LON).min().alias("lon_min"), pl.col(LON).max().alias("lon_max"),
+    ).collect().row(0)
+    lat_range, lon_range = extent[:2], extent[2:]
+
+    base = data.lazy().select(*DIMENSIONS, bucket_expr(), LAT, LON)
+    frames = []
+    for nx in sorted(levels):
+        grid = make_grid(lat_range, lon_range, nx)
+        frames.append(
+            base.select(pl.lit(nx, pl.UInt16).alias("nx"), *DIMENSIONS, "bucket", cell_expr(grid))
+            .drop_nulls("cell")
+            .group_by(["nx", *DIMENSIONS, "bucket", "cell"])
+            .agg(pl.len().cast(pl.UInt32).alias("count"))
+        )
+    table = (
+        pl.concat(frames)
+        .with_columns(pl.col("cell").cast(pl.UInt32))
+        .sort(["nx", *DIMENSIONS, "bucket", "cell"])
+        .collect()
+    )
+    return table, (lat_range, lon_range)
+
+
+def write_pyramid(table, extent, levels, path, source=DATA_PATH):
+    """Write the pyramid with its lattice extent and source stamp as parquet metadata."""
+    lat_range, lon_range = extent
+    metadata = {
+        "lat_range": list(lat_range),
+        "lon_range": list(lon_range),
+        "levels": sorted(levels),
+        **source_stamp(source),
+    }
+    table.write_parquet(path, compression="zstd", metadata={METADATA_KEY: json.dumps(metadata)})
+
+
+class HexPyramid:
+    """Answers hexbin requests from the precomputed count table."""
+
+    def __init__(self, table, lat_range, lon_range, levels):
+        self.table = table
+        self.codes = enum_codes(table.schema)
+        self.lat_range = tuple(lat_range)
+        self.lon_range = tuple(lon_range)
+        self.levels = sorted(levels)
+        self.grids = {nx: make_grid(self.lat_range, self.lon_range, nx) for nx in self.levels}
+        self.x_range = tuple(project(0.0, np.array(self.lon_range))[0])
+        self.y_range = tuple(project(np.array(self.lat_range), 0.0)[1])
+        self._cells = {}
+        self._geometry = {}
+
+    @classmethod
+    def load(cls, path=None, source=DATA_PATH):
+        """Load the sidecar for ``source``; returns None if it is missing or stale."""
+        path = path or pyramid_path(source)
+        if not os.path.exists(path):
+            logger.info("No hexbin pyramid at %s, the map bins raw points.", path)
+            return None
+        metadata = json.loads(pl.read_parquet_metadata(path)[METADATA_KEY])
+        if os.path.exists(source) and source_stamp(source) != {
+            "source_size": metadata["source_size"],
+            "source_mtime_ns": metadata["source_mtime_ns"],
+        }:
+            logger.warning("Hexbin pyramid %s is stale for %s, ignoring it. Rebuild with `python pyramid.py`.",
+                           path, source)
+            return None
+        return cls(pl.read_parquet(path), metadata["lat_range"], metadata["lon_range"], metadata["levels"])
+
+    def shared_geometry_level(self, grid):
+        """Level whose shared GeoJSON covers every hexagon of ``grid``, or None.
+
+        Any view binned on a pyramid grid only uses hexagons that are non-empty
+        in the unfiltered data, so one GeoJSON per level serves every filter
+        state and viewport, and updates only have to carry ids and counts.
+        """
+        nx = grid.nx
+        if self.grids.get(nx) != grid or len(self.level_cells(nx)) > SHARED_GEOMETRY_MAX_CELLS:
+            return None
+        return nx
+
+    def level_cells(self, nx):
+        """Sorted ids of the hexagons of level ``nx`` holding any occurrence."""
+        if nx not in self._cells:
+            self._cells[nx] = self.table.filter(pl.col("nx") == nx)["cell"].unique().sort().cast(pl.Int64).to_numpy()
+        return self._cells[nx]
+
+    def geometry(self, nx):
+        """Serialized GeoJSON of every non-empty hexagon of level ``nx``."""
+        if nx not in self._geometry:
+            self._geometry[nx] = json.dumps(hexagon_geojson(self.grids[nx], self.level_cells(nx)))
+        return self._geometry[nx]
+
+    def _rows(self, state):
+        if state.species is not None or state.years is not None or not bucket_filter_supported(state):
+            return None
+        expr = build_bucket_filter_expr(state, self.codes)
+        return self.table if expr is None else self.table.filter(expr)
+
+    def _extent(self, rows):
+        """Data extent of ``rows``, bounded by the finest level's hexagons."""
+        grid = self.grids[self.levels[-1]]
+        cells = rows.filter(pl.col("nx") == grid.nx)["cell"].unique().to_numpy()
+        cx, cy = cell_centers(grid, cells)
+        xmin = max(cx.min() - grid.dx / 2, self.x_range[0])
+        xmax = min(cx.max() + grid.dx / 2, self.x_range[1])
+        ymin = max(cy.min() - grid.dy / 3, self.y_range[0])
+        ymax = min(cy.max() + grid.dy / 3, self.y_range[1])
+        lat_range, lon_range = unproject(np.array([xmin, xmax]), np.array([ymin, ymax]))
+        return (xmin, xmax), tuple(lat_range.tolist()), tuple(lon_range.tolist())
+
+    def lookup(self, state, nx_hexagon, viewport=None):
+        """Hexbin counts for ``state`` at roughly ``nx_hexagon`` columns, or None if not precomputed.
+
+        With a ``viewport`` the hexagon size is chosen relative to the visible
+        area and only hexagons around it are returned.
+        """
+        rows = self._rows(state)
+        if rows is None:
+            return None
+        if rows.is_empty():
+            grid = self.grids[self.levels[0]]
+            empty = np.array([], dtype=np.int64)
+            return HexbinResult(grid, empty, empty, self.lat_range, self.lon_range)
+
+        if viewport is None:
+            (xmin, xmax), lat_range, lon_range = self._extent(rows)
+        else:
+            lat_range, lon_range = viewport.lat_range, viewport.lon_range
+            (xmin, xmax), (ymin, ymax) = project(np.array(lat_range), np.array(lon_range))
+        if xmax <= xmin:
+            return None
+        wanted_dx = (xmax - xmin) / int(nx_hexagon)
+        nx = min(self.levels, key=lambda level: abs(np.log(self.grids[level].dx / wanted_dx)))
+        grid = self.grids[nx]
+        if not 1 / MAX_SCALE_ERROR <= grid.dx / wanted_dx <= MAX_SCALE_ERROR:
+            return None
+
+        counts = (
+            rows.lazy()
+            .filter(pl.col("nx") == nx)
+            .group_by("cell")
+            .agg(pl.col("count").sum())
+            .sort("cell")
+            .collect()
+        )
+        cells = counts["cell"].cast(pl.Int64).to_numpy()
+        totals = counts["count"].cast(pl.Int64).to_numpy()
+        if viewport is not None:
+            cx, cy = cell_centers(grid, cells)
+            visible = (
+                (cx >= xmin - grid.dx) & (cx <= xmax + grid.dx)
+                & (cy >= ymin - grid.dy) & (cy <= ymax + grid.dy)
+            )
+            cells, totals = cells[visible], totals[visible]
+        return HexbinResult(grid, cells, totals, lat_range, lon_range)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the hexbin pyramid sidecar for the map.")
+    parser.add_argument("--source", default=DATA_PATH, help="Source parquet file.")
+    parser.add_argument("--output", default=None, help="Output path (default: next to the source).")
+    parser.add_argument("--levels", type=int, nargs="+", default=list(DEFAULT_LEVELS),
+                        help="Number of hexagons across the full extent for each level.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table, extent = build_pyramid(load_data("lazy", args.source), args.levels)
+    output = args.output or pyramid_path(args.source)
+    write_pyramid(table, extent, args.levels, output, args.source)
+    print(f"Wrote {table.height} rows for {len(args.levels)} levels to {output} "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
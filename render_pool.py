@@ -0,0 +1,110 @@
+"""Process pool for heavy callback work.
+
+Rendering the map for a large selection can take seconds, much of it holding
+the GIL. Running it in a pool of worker processes keeps the Dash request
+threads free for other users' quick callbacks. Workers are spawned rather
+than forked, since Polars' thread pool does not survive a fork; each worker
+imports the app once and keeps its data and caches between tasks.
+
+Every task belongs to a client (a browser tab). Submitting a new task for a
+client supersedes its previous one: a queued task is dropped before it starts,
+and a running one stops at its next ``checkpoint()``. Running tasks learn
+that they were superseded from a flag in a shared-memory array, so the pool
+needs no manager process, which would import the app like a worker does.
+
+Work that only the serving process needs at startup, like prewarming caches,
+should be skipped when ``in_worker()`` is true.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+# Tasks in flight that can be stopped while running; more run to completion.
+SUPERSEDE_SLOTS = 1024
+
+_superseded = None
+
+
+class Superseded(Exception):
+    """A newer task for the same client was submitted."""
+
+
+def in_worker():
+    """True in a process spawned by a pool rather than the server itself."""
+    return multiprocessing.parent_process() is not None
+
+
+def _init_worker(superseded):
+    global _superseded
+    _superseded = superseded
+
+
+def _run(fn, client, slot, args, kwargs):
+    def checkpoint():
+        if slot is not None and _superseded[slot]:
+            raise Superseded(client)
+
+    return fn(*args, checkpoint=checkpoint, **kwargs)
+
+
+class TaskPool:
+    """Spawned worker processes running one task per client at a time.
+
+    The processes are started on the first task rather than on construction:
+    spawned children re-import the main module, so a pool created at import
+    time would try to start another one in each child.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.free_slots = list(range(SUPERSEDE_SLOTS))
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self.superseded = context.RawArray("b", SUPERSEDE_SLOTS)
+        self.executor = ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=_init_worker, initargs=(self.superseded,)
+        )
+
+    def run(self, client, fn, *args, **kwargs):
+        """Run ``fn(*args, checkpoint=..., **kwargs)`` in a worker and wait for its result.
+
+        ``fn`` must be importable by the workers. Raises Superseded if another
+        task for ``client`` is submitted before this one finishes.
+        """
+        with self.lock:
+            if self.executor is None:
+                self._start()
+            previous = self.pending.get(client)
+            if previous is not None:
+                future, previous_slot = previous
+                if not future.cancel() and previous_slot is not None:
+                    self.superseded[previous_slot] = 1
+            slot = self.free_slots.pop() if self.free_slots else None
+            if slot is not None:
+                self.superseded[slot] = 0
+            future = self.executor.submit(_run, fn, client, slot, args, kwargs)
+            self.pending[client] = (future, slot)
+        try:
+            result = future.result()
+        except CancelledError:
+            raise Superseded(client)
+        finally:
+            with self.lock:
+                # The task has finished or will never start, so its slot can be reused.
+                if slot is not None:
+                    self.free_slots.append(slot)
+                current = self.pending.get(client, (None,))[0] is future
+                if current:
+                    del self.pending[client]
+        if not current:
+            raise Superseded(client)
+        return result
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
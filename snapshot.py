@@ -0,0 +1,191 @@
+"""Startup snapshot of the preprocessed dataset.
+
+Importing the app used to read the parquet, rename and encode the columns,
+build the facet cube and compute the initial dropdown options on every deploy
+and worker restart. The snapshot stores all of that in a versioned directory
+next to the parquet, keyed by the source's SHA-256 and mtime, so startup only
+has to read three Arrow IPC files and a JSON manifest. A snapshot whose source
+has changed is rebuilt automatically on the next start; build one ahead of a
+deploy with::
+
+    python snapshot.py build-snapshot
+
+Apps in lazy or mmap mode keep their own copy of the rows, so they only read
+the cubes and options. A snapshot built for them (``--no-frame``) has no
+frame and counts the cubes while streaming over a scan of the source, so the
+rows are never held in memory.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import NamedTuple, Optional
+
+import polars as pl
+
+from cube import TIME_DIMENSIONS, FacetCube, build_cube
+from data import CATEGORICAL_COLUMNS, DATA_PATH, encode_categoricals, load_data, source_stamp
+from dataset import dataset_sha256
+from filter_engine import FilterState
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever load_data() or build_cube() change what they produce.
+SNAPSHOT_VERSION = 4
+OPTION_COLUMNS = ["Country", "LifeStage", "Sex", "Species"]
+
+
+class Snapshot(NamedTuple):
+    data: Optional[pl.DataFrame]
+    cube: pl.DataFrame
+    time_cube: pl.DataFrame
+    options: dict
+
+
+def snapshot_dir(source=DATA_PATH):
+    """Directory holding the snapshot of ``source`` for the current version."""
+    root, _ = os.path.splitext(source)
+    return f"{root}.snapshot-v{SNAPSHOT_VERSION}"
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    if os.path.isdir(path):
+        return dataset_sha256(path, chunk_size)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_cubes(source=DATA_PATH):
+    """Facet and time cubes of ``source``, counted while streaming over a scan.
+
+    The labels are encoded on the cubes as ``load_data`` encodes them on the
+    eager frame, so the cubes match either way they are built.
+    """
+    scan = load_data("lazy", source, encode=False)
+    cube = encode_categoricals(build_cube(scan, engine="streaming"))
+    time_cube = build_cube(scan, TIME_DIMENSIONS, engine="streaming").with_columns(
+        pl.col(column).cast(cube.schema[column]) for column in TIME_DIMENSIONS if column in CATEGORICAL_COLUMNS
+    )
+    return cube, time_cube
+
+
+def build_snapshot(source=DATA_PATH, frame=True):
+    """Preprocess ``source`` into its snapshot: the cubes, option lists and, with ``frame``, the frame."""
+    start = time.perf_counter()
+    directory = snapshot_dir(source)
+    os.makedirs(directory, exist_ok=True)
+
+    if frame:
+        data = load_data("eager", source)
+        cube = build_cube(data)
+        time_cube = build_cube(data, TIME_DIMENSIONS)
+    else:
+        data = None
+        cube, time_cube = scan_cubes(source)
+    facets = FacetCube(cube)
+    options = {column: facets.options(FilterState(), column) for column in OPTION_COLUMNS}
+
+    frames = [("cube.arrow", cube), ("time_cube.arrow", time_cube)]
+    if frame:
+        frames.insert(0, ("frame.arrow", data))
+    elif os.path.exists(os.path.join(directory, "frame.arrow")):
+        os.remove(os.path.join(directory, "frame.arrow"))
+    for name, table in frames:
+        tmp_path = os.path.join(directory, f"{name}.{os.getpid()}.tmp")
+        table.write_ipc(tmp_path, compression="uncompressed")
+        os.replace(tmp_path, os.path.join(directory, name))
+
+    # The manifest is written last and marks the snapshot as complete.
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "source_sha256": file_sha256(source),
+        "frame": frame,
+        "options": options,
+        **source_stamp(source),
+    }
+    _write_manifest(directory, manifest)
+    logger.info("Built snapshot %s in %.1fs", directory, time.perf_counter() - start)
+    return Snapshot(data, cube, time_cube, options)
+
+
+def _write_manifest(directory, manifest):
+    tmp_path = os.path.join(directory, f"manifest.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(directory, "manifest.json"))
+
+
+def _fresh_manifest(source, directory, frame=True):
+    """The snapshot manifest if it matches ``source`` (and holds the frame if ``frame``), otherwise None.
+
+    Size and mtime are compared first; the source is only hashed when they
+    differ, and a matching hash just refreshes the recorded stamp.
+    """
+    manifest_path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_VERSION or (frame and not manifest.get("frame")):
+        return None
+    stamp = source_stamp(source)
+    if all(manifest.get(key) == value for key, value in stamp.items()):
+        return manifest
+    if file_sha256(source) != manifest.get("source_sha256"):
+        return None
+    manifest.update(stamp)
+    _write_manifest(directory, manifest)
+    return manifest
+
+
+def load_snapshot(source=DATA_PATH, build=True, frame=True):
+    """Load the snapshot of ``source``, (re)building it first if it is missing or stale.
+
+    Without ``frame`` the frame is neither read nor, when rebuilding, loaded,
+    and the snapshot's ``data`` is None. Concurrent workers serialize on a
+    lock file so only one of them rebuilds. Returns None if the snapshot is
+    stale and ``build`` is False.
+    """
+    import fcntl
+
+    directory = snapshot_dir(source)
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(directory, "build.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = _fresh_manifest(source, directory, frame)
+        if manifest is None:
+            if not build:
+                return None
+            logger.info("Snapshot %s is missing or stale, rebuilding it.", directory)
+            return build_snapshot(source, frame)
+
+    snapshot = Snapshot(
+        pl.read_ipc(os.path.join(directory, "frame.arrow")) if frame else None,
+        pl.read_ipc(os.path.join(directory, "cube.arrow")),
+        pl.read_ipc(os.path.join(directory, "time_cube.arrow")),
+        manifest["options"],
+    )
+    logger.info("Loaded snapshot %s in %.2fs", directory, time.perf_counter() - start)
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the startup snapshot of the dataset.")
+    parser.add_argument("command", choices=["build-snapshot"])
+    parser.add_argument("--source", default=DATA_PATH, help="Source parquet file.")
+    parser.add_argument("--no-frame", dest="frame", action="store_false",
+                        help="Leave out the frame, for apps in lazy or mmap mode.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_snapshot(args.source, args.frame)
+
+
+if __name__ == "__main__":
+    main()
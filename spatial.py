@@ -0,0 +1,117 @@
+"""Integer spatial keys for occurrences.
+
+Every occurrence gets a ``Quadkey``: the Web Mercator tile holding it at zoom
+``BASE_ZOOM`` (tiles of about 2.4 m at the equator), with the tile's x and y
+bits interleaved in Morton (Z-order) order. Dropping the two lowest bits gives
+the parent tile one zoom level up, so
+
+* the keys of a frame sorted by key are also grouped by tile at every coarser
+  zoom, and
+* a rectangle is covered by a few whole tiles, each of which is one
+  contiguous key range, so viewport queries become binary searches on the
+  sorted keys.
+
+``data.load_data`` adds the column to eager frames and sorts them by it.
+"""
+import numpy as np
+import polars as pl
+
+QUADKEY = "Quadkey"
+BASE_ZOOM = 24
+MAX_LAT = 85.0511
+
+_SPREAD = [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+           (2, 0x3333333333333333), (1, 0x5555555555555555)]
+_COMPACT = [(1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+            (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)]
+
+
+def _spread(v):
+    v = np.asarray(v, dtype=np.uint64)
+    for shift, mask in _SPREAD:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _compact(v):
+    v = np.asarray(v, dtype=np.uint64) & np.uint64(0x5555555555555555)
+    for shift, mask in _COMPACT:
+        v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def interleave(tx, ty):
+    """Key of the tiles with column ``tx`` and row ``ty`` (at any one zoom)."""
+    return _spread(tx) | (_spread(ty) << np.uint64(1))
+
+
+def tile_xy(keys):
+    """Inverse of ``interleave``: the (column, row) of each key."""
+    keys = np.asarray(keys, dtype=np.uint64)
+    return _compact(keys), _compact(keys >> np.uint64(1))
+
+
+def tiles(lat, lon, zoom=BASE_ZOOM):
+    """Column and row of the tiles at ``zoom`` holding the given coordinates (degrees)."""
+    n = 2 ** zoom
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LAT, MAX_LAT))
+    tx = np.clip(np.floor((np.asarray(lon, dtype=float) + 180) / 360 * n), 0, n - 1)
+    ty = np.clip(np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n), 0, n - 1)
+    return tx.astype(np.uint64), ty.astype(np.uint64)
+
+
+def _quadkey_batch(coordinates):
+    lat = coordinates.struct.field("lat").cast(pl.Float64).to_numpy()
+    lon = coordinates.struct.field("lon").cast(pl.Float64).to_numpy()
+    missing = np.isnan(lat) | np.isnan(lon)
+    keys = pl.Series(QUADKEY, interleave(*tiles(np.where(missing, 0, lat), np.where(missing, 0, lon))))
+    if not missing.any():
+        return keys
+    return pl.select(pl.when(pl.Series(missing)).then(None).otherwise(keys)).to_series()
+
+
+def quadkey_expr(lat, lon):
+    """Expression computing the ``Quadkey`` of each row from the ``lat``/``lon`` columns (null without both)."""
+    coordinates = pl.struct(pl.col(lat).alias("lat"), pl.col(lon).alias("lon"))
+    return coordinates.map_batches(_quadkey_batch, return_dtype=pl.UInt64).alias(QUADKEY)
+
+
+def key_ranges(lat_range, lon_range, max_tiles=8):
+    """Sorted, merged ``[start, stop)`` key ranges of tiles covering the rectangle.
+
+    The tiles are taken at the zoom where the rectangle spans at most
+    ``max_tiles`` of them along each axis.
+    """
+    # Rows count from the north, so the northern edge has the smaller row.
+    lat, lon = np.asarray(lat_range, dtype=float)[::-1], np.asarray(lon_range, dtype=float)
+    extent = max((lon[1] - lon[0]) / 360, 1e-12)
+    zoom = int(min(BASE_ZOOM, max(0, np.floor(np.log2(max_tiles / extent)))))
+    while True:
+        tx, ty = tiles(lat, lon, zoom)
+        if zoom == 0 or ty[1] - ty[0] < max_tiles:
+            break
+        zoom -= 1
+
+    columns, rows = np.meshgrid(np.arange(tx[0], tx[1] + 1), np.arange(ty[0], ty[1] + 1))
+    starts = np.sort(interleave(columns.ravel(), rows.ravel())) << np.uint64(2 * (BASE_ZOOM - zoom))
+    stops = starts + (np.uint64(1) << np.uint64(2 * (BASE_ZOOM - zoom)))
+    # Adjacent tiles along the Z-order curve become one range.
+    breaks = np.flatnonzero(starts[1:] != stops[:-1])
+    return np.stack([np.r_[starts[0], starts[breaks + 1]], np.r_[stops[breaks], stops[-1]]], axis=1)
+
+
+def clip_sorted(points, lat_range, lon_range, lat, lon):
+    """Rows of a frame sorted by ``Quadkey`` that fall inside the rectangle.
+
+    Only the rows within the covering key ranges are compared against the
+    coordinates.
+    """
+    keys = points[QUADKEY].to_numpy()
+    ranges = key_ranges(lat_range, lon_range)
+    starts = np.searchsorted(keys, ranges[:, 0], side="left")
+    stops = np.searchsorted(keys, ranges[:, 1], side="left")
+    rows = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+    candidates = points[rows]
+    return candidates.filter(
+        pl.col(lat).is_between(*lat_range) & pl.col(lon).is_between(*lon_range)
+    )
@@ -0,0 +1,52 @@
+"""Time series chart of occurrences per month.
+
+The counts come from the facet cube's Year and Month dimensions (see
+``cube.FacetCube.month_counts``), so the chart costs a small group-by
+whatever the filters. It always spans every year; the selected year range is
+drawn as a shaded band, which is all that changes while the range slider
+moves.
+"""
+import plotly.graph_objects as go
+import polars as pl
+
+from payload import compact_figure
+
+
+def year_span(years):
+    """Layout shape shading the inclusive ``(first, last)`` year range."""
+    first, last = years
+    return {
+        "type": "rect", "xref": "x", "yref": "paper", "x0": f"{first}-01-01", "x1": f"{last + 1}-01-01",
+        "y0": 0, "y1": 1, "fillcolor": "rgba(0, 123, 255, 0.12)", "line": {"width": 0}, "layer": "below",
+    }
+
+
+def timeline_figure(counts, years=None):
+    """Figure dict of monthly bars from a ``Year``/``Month``/``count`` frame, shading ``years`` if set.
+
+    Occurrences with a year but no month have no bar; the title says how many.
+    """
+    dated = counts.filter(pl.col("Month").is_not_null())
+    undated = counts["count"].sum() - dated["count"].sum()
+    title = "Occurrences per Month"
+    if undated:
+        title += f" ({undated:,} with only a year not shown)"
+    months = dated.select(pl.format("{}-{}", "Year", pl.col("Month").cast(pl.String).str.zfill(2)))
+    fig = go.Figure(
+        go.Bar(
+            x=months.to_series().to_list(),
+            y=dated["count"].to_numpy(),
+            xperiod="M1",
+            xperiodalignment="middle",
+            hovertemplate="%{x|%B %Y}<br>count=%{y}<extra></extra>",
+            marker={"color": "#636efa"},
+        ),
+        layout={
+            "title": {"text": title},
+            "xaxis": {"type": "date", "title": {"text": "Month"}},
+            "yaxis": {"title": {"text": "count"}},
+            "shapes": [] if years is None else [year_span(years)],
+            "bargap": 0,
+        },
+    )
+    return compact_figure(fig)
@@ -0,0 +1,57 @@
+"""Viewport handling for the occurrence map.
+
+The browser reports pan/zoom through the map's ``relayoutData``. A debounced
+clientside callback (``assets/viewport.js``) turns those events into a small
+viewport dict in a ``dcc.Store``; the map callback then bins only the points
+inside the visible area on a grid spanning it, so hexagons get finer as the
+user zooms in.
+"""
+from typing import NamedTuple
+
+from hexbin import LAT, LON
+from spatial import MAX_LAT, QUADKEY, clip_sorted
+
+
+class Viewport(NamedTuple):
+    lat_range: tuple
+    lon_range: tuple
+    zoom: float
+
+
+def map_revision(state):
+    """uirevision for the map: the view is kept until the country selection changes."""
+    return "|".join(state.country) or "All"
+
+
+def parse_viewport(data, revision):
+    """Viewport from the debounced store, or None if absent or captured for another revision."""
+    if not data or data.get("uirevision") != revision:
+        return None
+    lat_min, lat_max = sorted(data["lat_range"])
+    lon_min, lon_max = sorted(data["lon_range"])
+    if lon_max - lon_min >= 360:
+        lon_min, lon_max = -180.0, 180.0
+    return Viewport(
+        (max(lat_min, -MAX_LAT), min(lat_max, MAX_LAT)),
+        (max(lon_min, -180.0), min(lon_max, 180.0)),
+        float(data.get("zoom", 0)),
+    )
+
+
+def sort_points(df):
+    """Drop points without coordinates and sort by ``Quadkey`` for ``clip_points``.
+
+    Frames filtered from the eager dataset are already in key order and are
+    only checked.
+    """
+    points = df.select(QUADKEY, LAT, LON).drop_nulls()
+    return points if points[QUADKEY].is_sorted() else points.sort(QUADKEY)
+
+
+def clip_points(points, viewport):
+    """Points of a ``Quadkey``-sorted frame that fall inside ``viewport``.
+
+    The tiles covering the viewport are found by binary search on the keys, so
+    only the rows in those tiles are compared against the bounds.
+    """
+    return clip_sorted(points, viewport.lat_range, viewport.lon_range, LAT, LON)